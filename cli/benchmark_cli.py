@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+from lib.batch import read_queries
+from lib.documents import generate_corpus
+from lib.benchmark import RETRIEVERS, SCALE_RETRIEVERS, compare_reports, load_judgments, run_benchmark, scale_benchmark
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Retrieval Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    run_parser = subparsers.add_parser("run", help="Measure latency, throughput, memory and quality of each retriever on the movies")
+    run_parser.add_argument("--queries-file", type=str, help="JSONL file of queries, defaults to the judged queries")
+    run_parser.add_argument("--judgments", type=str, help="JSON of {query: [relevant ids]} or {query: {id: grade}} for recall, MRR and nDCG")
+    run_parser.add_argument("--retrievers", type=str, nargs="+", choices=RETRIEVERS, default=list(RETRIEVERS), help="retrievers to benchmark, in order")
+    run_parser.add_argument("--limit", type=int, default=10, help="results per query, the k of the quality metrics")
+    run_parser.add_argument("--runs", type=int, default=1, help="times the query set is run, latencies are over every run")
+    run_parser.add_argument("--warmup", type=int, default=0, help="queries run before measuring")
+    run_parser.add_argument("--rebuild", action="store_true", help="time a from scratch build of every index instead of loading ./cache")
+    run_parser.add_argument("--query-cache", action="store_true", help="keep the query embedding cache, by default every query is encoded")
+    run_parser.add_argument("--output", type=str, help="write the JSON report here instead of stdout")
+
+    generate_parser = subparsers.add_parser("generate", help="Write a synthetic corpus with known item queries and judgments")
+    generate_parser.add_argument("docs", type=int, help="number of movies")
+    generate_parser.add_argument("out_dir", type=str, help="directory for movies.jsonl, queries.jsonl and judgments.json")
+    generate_parser.add_argument("--queries", type=int, default=200, help="number of known item queries")
+    generate_parser.add_argument("--vocabulary", type=int, default=50000, help="distinct words")
+    generate_parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+    scale_parser = subparsers.add_parser("scale", help="Benchmark builds and queries over generated corpora of increasing size")
+    scale_parser.add_argument("corpora", type=str, nargs="+", help="movies.jsonl files written by generate")
+    scale_parser.add_argument("--retrievers", type=str, nargs="+", choices=SCALE_RETRIEVERS, default=["keyword"], help="retrievers to benchmark, chunked encodes every corpus")
+    scale_parser.add_argument("--limit", type=int, default=10, help="results per query, the k of the quality metrics")
+    scale_parser.add_argument("--runs", type=int, default=1, help="times the query set is run")
+    scale_parser.add_argument("--warmup", type=int, default=0, help="queries run before measuring")
+    scale_parser.add_argument("--output", type=str, help="write the JSON report here instead of stdout")
+
+    compare_parser = subparsers.add_parser("compare", help="Show the metrics of two run reports side by side")
+    compare_parser.add_argument("base", type=str, help="baseline report")
+    compare_parser.add_argument("new", type=str, help="report to compare against it")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "run":
+            judgments = load_judgments(args.judgments) if args.judgments else None
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+            elif judgments is not None:
+                queries = list(judgments)
+            else:
+                run_parser.error("--queries-file or --judgments is required")
+            try:
+                report = run_benchmark(queries, judgments, args.retrievers, args.limit, args.runs, args.warmup, args.rebuild, args.query_cache)
+            except KeyError:
+                print("ERROR: Key 'movies' not found in dictionary")
+                return
+            print_summary(report)
+            write_report(report, args.output)
+        case "generate":
+            corpus_path = generate_corpus(args.docs, args.out_dir, args.queries, args.vocabulary, args.seed)
+            print(f"Wrote {args.docs} movies to {corpus_path}")
+        case "scale":
+            report = scale_benchmark(args.corpora, args.retrievers, args.limit, args.runs, args.warmup)
+            for size in report["sizes"]:
+                print_summary(size)
+            write_report(report, args.output)
+        case "compare":
+            with open(args.base, "r") as f:
+                base = json.load(f)
+            with open(args.new, "r") as f:
+                new = json.load(f)
+            for name, metric, base_value, new_value in compare_reports(base, new):
+                change = f"{(new_value - base_value) / base_value * 100:+.1f}%" if base_value != 0 else ""
+                print(f"{name:10} {metric:28} {base_value:12.4f} {new_value:12.4f} {change}")
+        case _:
+            parser.print_help()
+
+
+def print_summary(report):
+    # to stderr, stdout carries the JSON report
+    print(f"{report["documents"]} movies, {report["queries"]} queries", file=sys.stderr)
+    for name, r in report["retrievers"].items():
+        latency = r["latency_ms"]
+        line = f"{name:10} setup {r["setup_s"]:7.2f}s  p50 {latency["p50"]:7.2f}ms  p95 {latency["p95"]:7.2f}ms  p99 {latency["p99"]:7.2f}ms  {r["qps"]:8.1f} qps  {r["peak_rss_mb"]:7.1f}MB"
+        if "mrr" in r:
+            line += f"  mrr {r["mrr"]:.3f}  ndcg@{report["limit"]} {r[f"ndcg@{report["limit"]}"]:.3f}  recall@{report["limit"]} {r[f"recall@{report["limit"]}"]:.3f}"
+        print(line, file=sys.stderr)
+
+
+def write_report(report, path):
+    if path is None:
+        print(json.dumps(report, indent=2))
+        return
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 import argparse
-import json
+from lib.ann import DEFAULT_NPROBE
+from lib.batch import read_queries, write_results
+from lib.documents import load_documents
+from lib.filters import parse_filters, print_facets
 from lib.hybrid_search import normalize_scores, HybridSearch
+from lib.quantization import QUANTIZATION_MODES
+from lib.search_client import remote_search
+from lib.tracing import PROFILERS, print_trace, traced
 
 
 def main() -> None:
@@ -11,44 +17,118 @@ def main() -> None:
     normalize_parser.add_argument("scores", type=float, nargs="+", help="")
 
     weighted_search_parser = subparsers.add_parser("weighted-search", help="")
-    weighted_search_parser.add_argument("query", type=str, help="")
+    weighted_search_parser.add_argument("query", type=str, nargs="?", help="")
     weighted_search_parser.add_argument("--alpha", type=float, default=0.5, help="")
     weighted_search_parser.add_argument("--limit", type=int, default=5, help="")
+    weighted_search_parser.add_argument("--candidates", type=int, help="results each leg retrieves before fusion, defaults to --limit")
+    weighted_search_parser.add_argument("--queries-file", type=str, help="JSONL file of queries to run as one batch, - for stdin")
+    weighted_search_parser.add_argument("--server", type=str, help="url of a running search server to query instead of loading locally")
+    weighted_search_parser.add_argument("--ann", action="store_true", help="use the IVF approximate nearest neighbour index for the semantic leg")
+    weighted_search_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="inverted lists to probe with --ann")
+    weighted_search_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="chunk embedding storage mode")
+    weighted_search_parser.add_argument("--concurrent", action="store_true", help="run the keyword and semantic legs in parallel")
+    weighted_search_parser.add_argument("--leg-timeout", type=float, help="seconds to wait for each concurrent leg before fusing without it")
+    weighted_search_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+    weighted_search_parser.add_argument("--facets", type=str, nargs="*", help="print value counts of these fields, every faceted field when none are given")
+    weighted_search_parser.add_argument("--profile", action="store_true", help="print per stage timings and counters after the results")
+    weighted_search_parser.add_argument("--profiler", type=str, choices=PROFILERS, help="also run the query under cProfile or pyinstrument and print its report")
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="")
-    rrf_search_parser.add_argument("query", type=str, help="")
+    rrf_search_parser.add_argument("query", type=str, nargs="?", help="")
     rrf_search_parser.add_argument("-k", type=int, default=60, help="")
     rrf_search_parser.add_argument("--limit", type=int, default=5, help="")
+    rrf_search_parser.add_argument("--candidates", type=int, help="results each leg retrieves before fusion, defaults to --limit")
+    rrf_search_parser.add_argument("--queries-file", type=str, help="JSONL file of queries to run as one batch, - for stdin")
+    rrf_search_parser.add_argument("--server", type=str, help="url of a running search server to query instead of loading locally")
+    rrf_search_parser.add_argument("--ann", action="store_true", help="use the IVF approximate nearest neighbour index for the semantic leg")
+    rrf_search_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="inverted lists to probe with --ann")
+    rrf_search_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="chunk embedding storage mode")
+    rrf_search_parser.add_argument("--concurrent", action="store_true", help="run the keyword and semantic legs in parallel")
+    rrf_search_parser.add_argument("--leg-timeout", type=float, help="seconds to wait for each concurrent leg before fusing without it")
+    rrf_search_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+    rrf_search_parser.add_argument("--facets", type=str, nargs="*", help="print value counts of these fields, every faceted field when none are given")
+    rrf_search_parser.add_argument("--profile", action="store_true", help="print per stage timings and counters after the results")
+    rrf_search_parser.add_argument("--profiler", type=str, choices=PROFILERS, help="also run the query under cProfile or pyinstrument and print its report")
 
     args = parser.parse_args()
+    if args.command in ("rrf-search", "weighted-search") and args.query is None and args.queries_file is None:
+        parser.error("a query or --queries-file is required")
+    if args.command in ("rrf-search", "weighted-search") and args.queries_file and (args.filter or args.facets is not None):
+        parser.error("--filter and --facets apply to a single query, not --queries-file")
+    if args.command in ("rrf-search", "weighted-search") and args.nprobe < 1:
+        parser.error("--nprobe must be at least 1")
+    if args.command in ("rrf-search", "weighted-search") and args.queries_file and args.server:
+        parser.error("--server runs a single query, not --queries-file")
+    if args.command in ("rrf-search", "weighted-search") and (args.queries_file or args.server) and (args.profile or args.profiler):
+        parser.error("--profile and --profiler apply to a single local query")
 
     match args.command:
         case "rrf-search":
-            documents = []
-            with open("./data/movies.json", "r") as file:
-                data = json.load(file)
-                if "movies" not in data:
-                    print("ERROR: Key 'movies' not found in dictionary")
+            if args.server and args.query is not None:
+                try:
+                    results = remote_search(args.server, "rrf", args.query, limit=args.limit, k=args.k, candidates=args.candidates, filters=args.filter, facets=args.facets)
+                except ValueError as e:
+                    print(f"ERROR: {e}")
                     return
-                documents = data.get("movies")
-            hs = HybridSearch(documents)
-            results = hs.rrf_search(args.query, args.limit, args.k)
-            for i, r in enumerate(results.values()):
-                print()
-                print(f"{i+1}. {r["document"]["title"]}\r\n   RRF Score: {r["score"]:.4f}\r\n   BM25 Rank: {r["bm25_rank"]:.4f}, Semantic Rank: {r["semantic_rank"]:.4f}\r\n   {r["document"]["description"][:50]}")
+                print_rrf_results(results, args.facets is not None)
+                return
+            documents = load_documents()
+            if documents is None:
+                return
+            hs = HybridSearch(documents, args.ann, args.nprobe, args.quantization, args.concurrent, args.leg_timeout)
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+                batch_results = hs.rrf_search_batch(queries, args.limit, args.k, args.candidates)
+                write_results(queries, [
+                    [
+                        {"id": doc_id, "title": r["document"]["title"], "score": r["score"], "bm25_rank": r["bm25_rank"], "semantic_rank": r["semantic_rank"]}
+                        for doc_id, r in results.items()
+                    ]
+                    for results in batch_results
+                ])
+                return
+            try:
+                results, trace, profiler_report = traced(
+                    lambda: hs.rrf_search(args.query, args.limit, args.k, args.candidates, parse_filters(args.filter), args.facets), args.profile, args.profiler
+                )
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            print_rrf_results(results, args.facets is not None)
+            print_trace(trace, profiler_report)
         case "weighted-search":
-            documents = []
-            with open("./data/movies.json", "r") as file:
-                data = json.load(file)
-                if "movies" not in data:
-                    print("ERROR: Key 'movies' not found in dictionary")
+            if args.server and args.query is not None:
+                try:
+                    results = remote_search(args.server, "weighted", args.query, limit=args.limit, alpha=args.alpha, candidates=args.candidates, filters=args.filter, facets=args.facets)
+                except ValueError as e:
+                    print(f"ERROR: {e}")
                     return
-                documents = data.get("movies")
-            hs = HybridSearch(documents)
-            results = hs.weighted_search(args.query, args.alpha, args.limit)
-            for i, r in enumerate(results.values()):
-                print()
-                print(f"{i+1}. {r["document"]["title"]}\r\n   Hybrid Score: {r["hybrid"]:.4f}\r\n   BM25: {r["bm25"]:.4f}, Semantic: {r["semantic"]:.4f}\r\n   {r["document"]["description"][:50]}")
+                print_weighted_results(results, args.facets is not None)
+                return
+            documents = load_documents()
+            if documents is None:
+                return
+            hs = HybridSearch(documents, args.ann, args.nprobe, args.quantization, args.concurrent, args.leg_timeout)
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+                batch_results = hs.weighted_search_batch(queries, args.alpha, args.limit, args.candidates)
+                write_results(queries, [
+                    [
+                        {"id": doc_id, "title": r["document"]["title"], "hybrid": r["hybrid"], "bm25": r["bm25"], "semantic": r["semantic"]}
+                        for doc_id, r in results.items()
+                    ]
+                    for results in batch_results
+                ])
+                return
+            try:
+                results, trace, profiler_report = traced(
+                    lambda: hs.weighted_search(args.query, args.alpha, args.limit, args.candidates, parse_filters(args.filter), args.facets), args.profile, args.profiler
+                )
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            print_weighted_results(results, args.facets is not None)
+            print_trace(trace, profiler_report)
         case "normalize":
             if args.scores is not None:
                 scores = args.scores
@@ -57,11 +137,33 @@ def main() -> None:
                 if min_score == max_score:
                     normalized_scores = [1.0 for score in scores]
                 else:
-                    normalized_scores = normalize_scores(scores)
+                    normalized_scores = list(normalize_scores(dict(enumerate(scores))).values())
                 print("Normalized Scores:", normalized_scores)
         case _:
             parser.print_help()
 
 
+def print_rrf_results(results, with_facets=False):
+    facets = None
+    if with_facets:
+        results, facets = results
+    for i, r in enumerate(results.values()):
+        print()
+        print(f"{i+1}. {r["document"]["title"]}\r\n   RRF Score: {r["score"]:.4f}\r\n   BM25 Rank: {r["bm25_rank"]:.4f}, Semantic Rank: {r["semantic_rank"]:.4f}\r\n   {r["document"]["description"][:50]}")
+    if facets is not None:
+        print_facets(facets)
+
+
+def print_weighted_results(results, with_facets=False):
+    facets = None
+    if with_facets:
+        results, facets = results
+    for i, r in enumerate(results.values()):
+        print()
+        print(f"{i+1}. {r["document"]["title"]}\r\n   Hybrid Score: {r["hybrid"]:.4f}\r\n   BM25: {r["bm25"]:.4f}, Semantic: {r["semantic"]:.4f}\r\n   {r["document"]["description"][:50]}")
+    if facets is not None:
+        print_facets(facets)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,7 +2,13 @@
 
 import argparse
 import math
-from lib.keyword_search import InvertedIndex, tokenize
+import time
+from lib.batch import read_queries, write_results
+from lib.documents import load_documents
+from lib.filters import parse_filters, print_facets
+from lib.keyword_search import PARALLEL_BUILD_MIN_DOCUMENTS, InvertedIndex, tokenize
+from lib.search_client import remote_search
+from lib.tracing import PROFILERS, print_trace, traced
 
 stopwords = []
 BM25_K1 = 1.5
@@ -16,6 +22,11 @@ def main() -> None:
     search_parser.add_argument("query", type=str, help="Search query")
 
     build = subparsers.add_parser("build", help="Build inverted index and save to disk")
+    build.add_argument("--workers", type=int, default=1, help=f"processes to tokenize and index with, corpora under {PARALLEL_BUILD_MIN_DOCUMENTS} movies are built serially")
+
+    update = subparsers.add_parser("update", help="Apply added, changed and deleted movies to the saved index")
+
+    migrate = subparsers.add_parser("migrate", help="Convert a pickled index in ./cache to the segment format")
 
     tf = subparsers.add_parser("tf", help="Term Frequency")
     tf.add_argument("doc_id", type=int, help="Term frequency search doc_id")
@@ -38,8 +49,28 @@ def main() -> None:
     bm25tf.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tunable BM25 b parameter")
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
-    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("query", type=str, nargs='?', help="Search query")
     bm25search_parser.add_argument("limit", type=int, nargs='?', default=5, help="limit")
+    bm25search_parser.add_argument("--queries-file", type=str, help="JSONL file of queries to run as one batch, - for stdin")
+    bm25search_parser.add_argument("--server", type=str, help="url of a running search server to query instead of loading locally")
+    bm25search_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+    bm25search_parser.add_argument("--facets", type=str, nargs="*", help="print value counts of these fields, every faceted field when none are given")
+    bm25search_parser.add_argument("--profile", action="store_true", help="print per stage timings and counters after the results")
+    bm25search_parser.add_argument("--profiler", type=str, choices=PROFILERS, help="also run the query under cProfile or pyinstrument and print its report")
+
+    impactsearch_parser = subparsers.add_parser("impactsearch", help="Search movies using precomputed, quantized BM25 impacts")
+    impactsearch_parser.add_argument("query", type=str, help="Search query")
+    impactsearch_parser.add_argument("limit", type=int, nargs='?', default=5, help="limit")
+    impactsearch_parser.add_argument("--k1", type=float, default=BM25_K1, help="Tunable BM25 k1 parameter")
+    impactsearch_parser.add_argument("--b", type=float, default=BM25_B, help="Tunable BM25 b parameter")
+
+    build_impacts_parser = subparsers.add_parser("build_impacts", help="Precompute BM25 impacts for k1/b from the saved index, without retokenizing")
+    build_impacts_parser.add_argument("--k1", type=float, default=BM25_K1, help="Tunable BM25 k1 parameter")
+    build_impacts_parser.add_argument("--b", type=float, default=BM25_B, help="Tunable BM25 b parameter")
+
+    phrasesearch_parser = subparsers.add_parser("phrasesearch", help="Search movies using phrase (\"toy story\") and proximity (toy NEAR/3 story) queries")
+    phrasesearch_parser.add_argument("query", type=str, help="Search query")
+    phrasesearch_parser.add_argument("limit", type=int, nargs='?', default=5, help="limit")
 
     test = subparsers.add_parser("test", help="test functionality")
     test.add_argument("query", type=str, help="Search query")
@@ -56,7 +87,23 @@ def main() -> None:
         case "build":
             ii = InvertedIndex()
             print("Building movies index")
-            ii.build()
+            ii.build(args.workers)
+            print("Saving movies index to disk")
+            ii.save()
+        case "update":
+            movies = load_documents()
+            if movies is None:
+                return
+            ii = InvertedIndex()
+            print("Updating movies index")
+            counts = ii.update(movies)
+            print(f"{counts["added"]} added, {counts["updated"]} updated, {counts["deleted"]} deleted")
+            print("Saving movies index to disk")
+            ii.save()
+        case "migrate":
+            ii = InvertedIndex()
+            print("Loading pickled movies index")
+            ii.load_pickles()
             print("Saving movies index to disk")
             ii.save()
         case "tf":
@@ -91,10 +138,58 @@ def main() -> None:
             bm25tf = ii.get_bm25_tf(args.doc_id, args.term, args.k1, args.b)
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
         case "bm25search":
+            if args.queries_file and (args.filter or args.facets is not None):
+                bm25search_parser.error("--filter and --facets apply to a single query, not --queries-file")
+            if args.queries_file and args.server:
+                bm25search_parser.error("--server runs a single query, not --queries-file")
+            if (args.queries_file or args.server) and (args.profile or args.profiler):
+                bm25search_parser.error("--profile and --profiler apply to a single local query")
+            if args.server and args.query is not None:
+                try:
+                    bm25_search_results = remote_search(args.server, "keyword", args.query, limit=args.limit, filters=args.filter, facets=args.facets)
+                except ValueError as e:
+                    print(f"ERROR: {e}")
+                    return
+                print_bm25_results(bm25_search_results, args.facets is not None)
+                return
             ii = InvertedIndex()
             ii.load()
-            bm25_search_results = ii.bm25_search(args.query, args.limit)
-            for index, r in enumerate(bm25_search_results.values()):
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+                batch_results = ii.bm25_search_batch(queries, args.limit)
+                write_results(queries, [
+                    [{"id": r["movie"]["id"], "title": r["movie"]["title"], "score": r["score"]} for r in results.values()]
+                    for results in batch_results
+                ])
+                return
+            if args.query is None:
+                bm25search_parser.error("a query or --queries-file is required")
+            try:
+                bm25_search_results, trace, profiler_report = traced(
+                    lambda: ii.bm25_search(args.query, args.limit, parse_filters(args.filter), args.facets), args.profile, args.profiler
+                )
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            print_bm25_results(bm25_search_results, args.facets is not None)
+            print_trace(trace, profiler_report)
+        case "impactsearch":
+            ii = InvertedIndex()
+            ii.load()
+            impact_search_results = ii.impact_search(args.query, args.limit, args.k1, args.b)
+            for index, r in enumerate(impact_search_results.values()):
+                print(f"{index}. ({r["movie"]["id"]}) {r["movie"]["title"]} - Score: {r["score"]:.2f}")
+        case "build_impacts":
+            ii = InvertedIndex()
+            ii.load()
+            start = time.perf_counter()
+            impact_index = ii.load_or_create_impacts(args.k1, args.b)
+            print(f"Impacts for k1={args.k1}, b={args.b}: {len(impact_index.impacts)} postings in {time.perf_counter() - start:.2f}s")
+        case "phrasesearch":
+            ii = InvertedIndex()
+            ii.load()
+            phrase_search_results = ii.positional_search(args.query, args.limit)
+            for index, r in enumerate(phrase_search_results.values()):
                 print(f"{index}. ({r["movie"]["id"]}) {r["movie"]["title"]} - Score: {r["score"]:.2f}")
         case "test":
             ii = InvertedIndex()
@@ -108,6 +203,16 @@ def main() -> None:
 
 
 
+def print_bm25_results(results, with_facets=False):
+    facets = None
+    if with_facets:
+        results, facets = results
+    for index, r in enumerate(results.values()):
+        print(f"{index}. ({r["movie"]["id"]}) {r["movie"]["title"]} - Score: {r["score"]:.2f}")
+    if facets is not None:
+        print_facets(facets)
+
+
 def test_search(search):
     movieIndex = InvertedIndex()
     movieIndex.load()
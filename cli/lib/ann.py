@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 20
+# assignment is done in blocks so (vectors x centroids) never gets huge
+ASSIGN_BLOCK_SIZE = 8192
+
+
+def default_nlist(n_vectors: int) -> int:
+    return max(1, min(n_vectors, int(4 * np.sqrt(n_vectors))))
+
+
+def assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        block = vectors[start : start + ASSIGN_BLOCK_SIZE]
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors: np.ndarray, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0):
+    # k-means on unit vectors with dot product similarity, centroids are
+    # renormalized after every update
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # reseed empty lists from random vectors
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    # inverted file index: a k-means coarse quantizer plus one inverted
+    # list of row ids per centroid, stored CSR style
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def n_vectors(self) -> int:
+        return len(self.list_ids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int | None = None, seed: int = 0):
+        # vectors must already be L2 normalized
+        if nlist is None:
+            nlist = default_nlist(len(vectors))
+        nlist = min(nlist, len(vectors))
+        centroids = spherical_kmeans(vectors, nlist, seed=seed)
+        assignments = assign_to_centroids(vectors, centroids)
+        list_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+        return cls(centroids, list_offsets, list_ids)
+
+    def candidates(self, query: np.ndarray, nprobe: int = DEFAULT_NPROBE) -> np.ndarray:
+        # row ids in the nprobe lists whose centroids are closest to the
+        # query; at least one list is always probed
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.list_ids[self.list_offsets[i] : self.list_offsets[i + 1]] for i in probe])
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_ids"])
+
+
+def recall_at_k(exact_ids, approx_ids) -> float:
+    exact_ids = list(exact_ids)
+    if len(exact_ids) == 0:
+        return 1.0
+    return len(set(exact_ids) & set(approx_ids)) / len(exact_ids)
@@ -0,0 +1,26 @@
+import json
+import sys
+
+
+def read_queries(path: str) -> list[str]:
+    # JSONL with one {"query": "..."} object (or bare JSON string) per line,
+    # "-" reads from stdin
+    file = sys.stdin if path == "-" else open(path, "r")
+    queries = []
+    try:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            entry = json.loads(line)
+            queries.append(entry["query"] if isinstance(entry, dict) else entry)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    return queries
+
+
+def write_results(queries: list[str], results: list):
+    # one JSON line per query, in input order
+    for query, result in zip(queries, results):
+        print(json.dumps({"query": query, "results": result}))
@@ -0,0 +1,279 @@
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .ann import recall_at_k
+from .documents import count_lines, iter_documents, read_jsonl
+from .embedding_cache import QueryEmbeddingCache
+from .hybrid_search import HybridSearch
+from .keyword_search import InvertedIndex
+from .semantic_search import ChunkedSemanticSearch, SemanticSearch
+
+RETRIEVERS = ("keyword", "semantic", "chunked", "rrf", "weighted")
+# the retrievers a scaling run can build away from ./cache
+SCALE_RETRIEVERS = ("keyword", "chunked")
+RRF_K = 60
+WEIGHTED_ALPHA = 0.5
+
+
+def peak_rss_mb() -> float:
+    # high-water mark of this process, ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if len(ms) > 0 else (0.0, 0.0, 0.0)
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(ms.mean()) if len(ms) > 0 else 0.0}
+
+
+def reciprocal_rank(relevant: dict, ranked: list) -> float:
+    for rank, doc_id in enumerate(ranked):
+        if relevant.get(doc_id, 0) > 0:
+            return 1 / (rank + 1)
+    return 0.0
+
+
+def ndcg_at_k(relevant: dict, ranked: list, k: int) -> float:
+    # graded gains, 2^grade - 1 discounted by log2(rank + 1)
+    dcg = sum((2 ** relevant.get(doc_id, 0) - 1) / math.log2(rank + 2) for rank, doc_id in enumerate(ranked[:k]))
+    ideal = sorted(relevant.values(), reverse=True)[:k]
+    idcg = sum((2 ** grade - 1) / math.log2(rank + 2) for rank, grade in enumerate(ideal))
+    return dcg / idcg if idcg > 0 else 0.0
+
+
+def load_judgments(path: str) -> dict:
+    # {"query": [relevant ids]} or {"query": {"id": grade}}, grades > 0 are relevant
+    with open(path, "r") as f:
+        raw = json.load(f)
+    judgments = {}
+    for query, relevant in raw.items():
+        if isinstance(relevant, dict):
+            judgments[query] = {int(doc_id): grade for doc_id, grade in relevant.items()}
+        else:
+            judgments[query] = {int(doc_id): 1 for doc_id in relevant}
+    return judgments
+
+
+def quality(judgments: dict, queries: list[str], rankings: list[list], k: int) -> dict:
+    # queries judged with nothing relevant have no recall or ideal ranking
+    # to measure against, they are left out rather than counted as perfect
+    judged = [
+        (judgments[query], ranked)
+        for query, ranked in zip(queries, rankings)
+        if query in judgments and any(grade > 0 for grade in judgments[query].values())
+    ]
+    if len(judged) == 0:
+        return {}
+    return {
+        "judged_queries": len(judged),
+        f"recall@{k}": sum(recall_at_k([d for d, g in rel.items() if g > 0], ranked[:k]) for rel, ranked in judged) / len(judged),
+        "mrr": sum(reciprocal_rank(rel, ranked) for rel, ranked in judged) / len(judged),
+        f"ndcg@{k}": sum(ndcg_at_k(rel, ranked, k) for rel, ranked in judged) / len(judged),
+    }
+
+
+def cold_query_cache(searcher: SemanticSearch):
+    # a cached query skips the model, so by default every query is encoded
+    searcher.query_cache = QueryEmbeddingCache(searcher.model_name, size=0, path=None)
+
+
+def setup_retriever(name: str, documents: list[dict], rebuild: bool = False, query_cache: bool = False):
+    # returns search(query, limit) -> ranked doc ids and the semantic
+    # searcher whose query cache stats are reported, if any; rebuild times
+    # a from scratch build instead of loading ./cache
+    match name:
+        case "keyword":
+            index = InvertedIndex()
+            if rebuild or not index.exists():
+                index.build()
+                index.save()
+            index.load()
+            return lambda query, limit: list(index.bm25_search(query, limit).keys()), None
+        case "semantic":
+            searcher = SemanticSearch()
+            if rebuild:
+                searcher.build_embeddings(documents)
+            else:
+                searcher.load_or_create_embeddings(documents)
+            if not query_cache:
+                cold_query_cache(searcher)
+            return lambda query, limit: [doc["id"] for _, doc in searcher.search(query, limit)], searcher
+        case "chunked":
+            searcher = ChunkedSemanticSearch()
+            if rebuild:
+                searcher.build_chunk_embeddings(documents)
+            else:
+                searcher.load_or_create_chunked_embeddings(documents)
+            if not query_cache:
+                cold_query_cache(searcher)
+            return lambda query, limit: [r["id"] for r in searcher.search_chunks(query, limit)], searcher
+        case "rrf" | "weighted":
+            # reuses the keyword and chunked caches, built when missing
+            hybrid = HybridSearch(documents)
+            if not query_cache:
+                cold_query_cache(hybrid.semantic_search)
+            if name == "rrf":
+                return lambda query, limit: list(hybrid.rrf_search(query, limit, RRF_K).keys()), hybrid.semantic_search
+            return lambda query, limit: list(hybrid.weighted_search(query, WEIGHTED_ALPHA, limit).keys()), hybrid.semantic_search
+    raise ValueError(f"Unknown retriever '{name}', expected one of {', '.join(RETRIEVERS)}")
+
+
+def measure(search, queries: list[str], limit: int, runs: int = 1, warmup: int = 0) -> tuple[dict, list[list]]:
+    # sequential queries, so qps is single client throughput
+    for query in queries[:warmup]:
+        search(query, limit)
+    latencies = []
+    rankings = []
+    start = time.perf_counter()
+    for run in range(runs):
+        for query in queries:
+            query_start = time.perf_counter()
+            ranked = search(query, limit)
+            latencies.append(time.perf_counter() - query_start)
+            if run == 0:
+                rankings.append(ranked)
+    elapsed = time.perf_counter() - start
+    return {
+        "latency_ms": latency_summary(latencies),
+        "qps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }, rankings
+
+
+def benchmark_retriever(name: str, setup, queries: list[str], judgments: dict | None, limit: int, runs: int, warmup: int) -> dict:
+    start = time.perf_counter()
+    search, searcher = setup()
+    report = {"setup_s": time.perf_counter() - start}
+    measured, rankings = measure(search, queries, limit, runs, warmup)
+    report.update(measured)
+    if judgments:
+        report.update(quality(judgments, queries, rankings, limit))
+    if searcher is not None:
+        report["query_cache"] = searcher.query_cache.stats()
+    # high-water mark of the process, run_isolated gives each retriever
+    # its own so this is that retriever's peak (interpreter and imports
+    # included)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def run_isolated(fn, *args):
+    # a fresh spawned process per retriever, so neither its peak memory
+    # nor its warm caches carry over to the next one
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def benchmark_loaded(name: str, queries: list[str], judgments: dict | None, limit: int, runs: int, warmup: int, rebuild: bool, query_cache: bool) -> dict:
+    documents = list(iter_documents())
+    return benchmark_retriever(
+        name, lambda: setup_retriever(name, documents, rebuild, query_cache), queries, judgments, limit, runs, warmup
+    )
+
+
+def benchmark_scaled(name: str, corpus_path: str, queries: list[str], judgments: dict, limit: int, runs: int, warmup: int) -> dict:
+    if name == "keyword":
+        setup = lambda: scale_keyword(corpus_path)
+    elif name == "chunked":
+        setup = lambda: scale_chunked(list(iter_documents(corpus_path)), os.path.dirname(corpus_path))
+    else:
+        raise ValueError(f"Retriever '{name}' can't be scaled, expected one of {', '.join(SCALE_RETRIEVERS)}")
+    return benchmark_retriever(name, setup, queries, judgments, limit, runs, warmup)
+
+
+def run_benchmark(
+    queries: list[str],
+    judgments: dict | None = None,
+    retrievers=RETRIEVERS,
+    limit: int = 10,
+    runs: int = 1,
+    warmup: int = 0,
+    rebuild: bool = False,
+    query_cache: bool = False,
+) -> dict:
+    # against ./data and ./cache, like the search CLIs
+    report = run_info(sum(1 for _ in iter_documents()), queries, judgments, limit, runs)
+    report["setup"] = "build" if rebuild else "load"
+    for name in retrievers:
+        print(f"Benchmarking {name}", file=sys.stderr)
+        report["retrievers"][name] = run_isolated(benchmark_loaded, name, queries, judgments, limit, runs, warmup, rebuild, query_cache)
+    return report
+
+
+def run_info(n_documents: int, queries: list[str], judgments: dict | None, limit: int, runs: int) -> dict:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "documents": n_documents,
+        "queries": len(queries),
+        "judged": judgments is not None,
+        "limit": limit,
+        "runs": runs,
+        "retrievers": {},
+    }
+
+
+def scale_benchmark(corpus_paths: list[str], retrievers=("keyword",), limit: int = 10, runs: int = 1, warmup: int = 0) -> dict:
+    # one entry per synthetic corpus (see generate_corpus), each built from
+    # scratch: the keyword index in memory, chunk embeddings under the
+    # corpus directory, never in ./cache
+    sizes = []
+    for corpus_path in corpus_paths:
+        corpus_dir = os.path.dirname(corpus_path)
+        queries = [entry["query"] for entry in read_jsonl(os.path.join(corpus_dir, "queries.jsonl"))]
+        judgments = load_judgments(os.path.join(corpus_dir, "judgments.json"))
+        report = run_info(count_lines(corpus_path), queries, judgments, limit, runs)
+        report["corpus"] = corpus_path
+        for name in retrievers:
+            print(f"Benchmarking {name} on {corpus_path}", file=sys.stderr)
+            report["retrievers"][name] = run_isolated(benchmark_scaled, name, corpus_path, queries, judgments, limit, runs, warmup)
+        sizes.append(report)
+    return {"sizes": sizes}
+
+
+def scale_keyword(corpus_path: str):
+    index = InvertedIndex()
+    index.build(path=corpus_path)
+    return lambda query, limit: list(index.bm25_search(query, limit).keys()), None
+
+
+def scale_chunked(documents: list[dict], corpus_dir: str):
+    searcher = ChunkedSemanticSearch(query_cache_path=None, cache_dir=corpus_dir)
+    searcher.load_or_create_chunked_embeddings(documents)
+    cold_query_cache(searcher)
+    return lambda query, limit: [r["id"] for r in searcher.search_chunks(query, limit)], searcher
+
+
+def compare_reports(base: dict, new: dict) -> list[tuple[str, str, float, float]]:
+    # (retriever, metric, base, new) for every numeric metric in both runs
+    rows = []
+    for name, base_report in base["retrievers"].items():
+        new_report = new["retrievers"].get(name)
+        if new_report is None:
+            continue
+        for metric, base_value, new_value in flatten_metrics(base_report, new_report):
+            rows.append((name, metric, base_value, new_value))
+    return rows
+
+
+def flatten_metrics(base: dict, new: dict, prefix: str = ""):
+    for key, base_value in base.items():
+        if key not in new:
+            continue
+        if isinstance(base_value, dict):
+            yield from flatten_metrics(base_value, new[key], f"{prefix}{key}.")
+        elif isinstance(base_value, (int, float)) and not isinstance(base_value, bool):
+            yield f"{prefix}{key}", base_value, new[key]
@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+CHUNK_METADATA_FILE = "chunk_metadata.npz"
+CHUNK_METADATA_PATH = os.path.join("./cache", CHUNK_METADATA_FILE)
+# list-of-dicts format written before the npz store, read for migration
+LEGACY_CHUNK_METADATA_FILE = "chunk_metadata.json"
+LEGACY_CHUNK_METADATA_PATH = os.path.join("./cache", LEGACY_CHUNK_METADATA_FILE)
+
+
+class ChunkMetadata:
+    # per chunk movie_idx / chunk_idx as parallel int32 arrays, rows of the
+    # chunk embedding matrix; chunks of a movie are contiguous, so
+    # movie_offsets[m]:movie_offsets[m + 1] is movie m's range (CSR style)
+    def __init__(self, movie_idx, chunk_idx, doc_hashes: list[str] | None, n_movies: int | None = None):
+        self.movie_idx = np.asarray(movie_idx, dtype=np.int32)
+        self.chunk_idx = np.asarray(chunk_idx, dtype=np.int32)
+        self.doc_hashes = doc_hashes
+        if n_movies is None:
+            n_movies = len(doc_hashes) if doc_hashes is not None else int(self.movie_idx.max(initial=-1)) + 1
+        counts = np.bincount(self.movie_idx, minlength=n_movies)
+        self.movie_offsets = np.zeros(n_movies + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.movie_offsets[1:])
+        self.total_chunks = counts[self.movie_idx].astype(np.int32)
+
+    def __len__(self):
+        return len(self.movie_idx)
+
+    def movie_rows(self, movie_idx: int) -> range:
+        return range(int(self.movie_offsets[movie_idx]), int(self.movie_offsets[movie_idx + 1]))
+
+    def record(self, row: int) -> dict:
+        # the per chunk dict search results used to carry
+        return {
+            "movie_idx": int(self.movie_idx[row]),
+            "chunk_idx": int(self.chunk_idx[row]),
+            "total_chunks": int(self.total_chunks[row]),
+        }
+
+    def matches(self, doc_hashes: list[str]) -> bool:
+        return self.doc_hashes is not None and self.doc_hashes == doc_hashes
+
+    def save(self, path: str = CHUNK_METADATA_PATH):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                movie_idx=self.movie_idx,
+                chunk_idx=self.chunk_idx,
+                doc_hashes=np.array(self.doc_hashes or [], dtype="S40"),
+            )
+
+    @classmethod
+    def load(cls, path: str = CHUNK_METADATA_PATH):
+        with np.load(path) as data:
+            doc_hashes = [h.decode("ascii") for h in data["doc_hashes"].tolist()]
+            return cls(data["movie_idx"], data["chunk_idx"], doc_hashes or None)
+
+    @classmethod
+    def load_json(cls, path: str = LEGACY_CHUNK_METADATA_PATH):
+        with open(path, "r") as f:
+            metadata = json.load(f)
+        chunks = metadata["chunks"] if isinstance(metadata, dict) else metadata
+        return cls(
+            [chunk["movie_idx"] for chunk in chunks],
+            [chunk["chunk_idx"] for chunk in chunks],
+            metadata.get("doc_hashes") if isinstance(metadata, dict) else None,
+        )
+
+    @classmethod
+    def load_or_migrate(cls, path: str = CHUNK_METADATA_PATH, legacy_path: str = LEGACY_CHUNK_METADATA_PATH):
+        if os.path.exists(path):
+            return cls.load(path)
+        if not os.path.exists(legacy_path):
+            return None
+        metadata = cls.load_json(legacy_path)
+        metadata.save(path)
+        os.remove(legacy_path)
+        return metadata
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+from itertools import islice
+
+import numpy as np
+
+MOVIES_PATH = "./data/movies.json"
+# one movie object per line, used instead of movies.json when present
+MOVIES_JSONL_PATH = "./data/movies.jsonl"
+READ_SIZE = 1 << 20
+# fields and word parts of generate_corpus's synthetic movies
+SYNTHETIC_GENRES = ["action", "comedy", "drama", "horror", "romance", "sci-fi", "thriller", "western", "animation", "documentary"]
+SYLLABLES = ["ka", "ro", "mi", "ten", "sa", "lo", "vur", "ne", "dai", "pel", "qui", "zor", "ba", "fen", "tis", "gra", "ul", "mon", "shi", "de"]
+
+
+def document_hash(document: dict) -> str:
+    # canonical JSON, so any edit to any field changes the hash
+    return hashlib.sha1(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def default_documents_path() -> str:
+    if os.path.exists(MOVIES_JSONL_PATH):
+        return MOVIES_JSONL_PATH
+    return MOVIES_PATH
+
+
+def iter_documents(path: str | None = None):
+    # yields movies one at a time without reading the whole file, from
+    # JSONL or from the "movies" array of a {"movies": [...]} document
+    path = path or default_documents_path()
+    with open(path, "r") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                line = line.strip()
+                if len(line) > 0:
+                    yield json.loads(line)
+        else:
+            yield from JSONArrayStream(file).iter_key("movies")
+
+
+def load_documents(path: str | None = None):
+    # shared loader for the CLIs, prints the error and returns None if the
+    # file has no movies
+    try:
+        return list(iter_documents(path))
+    except KeyError:
+        print("ERROR: Key 'movies' not found in dictionary")
+        return None
+
+
+def batched(iterable, n: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def synthetic_vocabulary(size: int, rng: np.random.Generator) -> list[str]:
+    # pronounceable made up words, unique, so stemming and stopwords barely
+    # touch them
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, rng.integers(2, 5))))
+    return sorted(words)
+
+
+def generate_corpus(n: int, out_dir: str, queries: int = 200, vocabulary: int = 50000, seed: int = 0) -> str:
+    # writes out_dir/movies.jsonl with zipf distributed words, plus
+    # queries.jsonl and judgments.json of known item queries: a few of a
+    # movie's rarest words, with that movie as the only relevant result
+    rng = np.random.default_rng(seed)
+    # zipf rank is random, not alphabetical
+    words = rng.permutation(synthetic_vocabulary(vocabulary, rng)).tolist()
+    # sampled by inverting the cdf, choice(p=...) rebuilds it on every call
+    cdf = np.cumsum(1 / np.arange(1, len(words) + 1) ** 1.1)
+    cdf /= cdf[-1]
+    os.makedirs(out_dir, exist_ok=True)
+    corpus_path = os.path.join(out_dir, "movies.jsonl")
+    query_ids = set(rng.choice(n, min(queries, n), replace=False).tolist()) if n > 0 else set()
+    known_items = []
+    with open(corpus_path, "w") as f:
+        for doc_id in range(1, n + 1):
+            title = np.searchsorted(cdf, rng.random(rng.integers(2, 5)))
+            description = np.searchsorted(cdf, rng.random(rng.integers(30, 120)))
+            # sentences of about a dozen words, for the semantic chunker
+            sentences = [" ".join(words[w] for w in description[i : i + 12]).capitalize() + "." for i in range(0, len(description), 12)]
+            f.write(json.dumps({
+                "id": doc_id,
+                "title": " ".join(words[w] for w in title).title(),
+                "description": " ".join(sentences),
+                "genre": SYNTHETIC_GENRES[int(rng.integers(len(SYNTHETIC_GENRES)))],
+                "year": int(rng.integers(1950, 2025)),
+            }) + "\n")
+            if doc_id - 1 in query_ids:
+                rarest = sorted(set(description.tolist()), reverse=True)[: int(rng.integers(2, 4))]
+                known_items.append((" ".join(words[w] for w in rarest), doc_id))
+    with open(os.path.join(out_dir, "queries.jsonl"), "w") as f:
+        for query, _ in known_items:
+            f.write(json.dumps({"query": query}) + "\n")
+    with open(os.path.join(out_dir, "judgments.json"), "w") as f:
+        json.dump({query: [doc_id] for query, doc_id in known_items}, f)
+    return corpus_path
+
+
+def read_jsonl(path: str) -> list:
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if len(line.strip()) > 0]
+
+
+def count_lines(path: str) -> int:
+    with open(path, "r") as f:
+        return sum(1 for line in f if len(line.strip()) > 0)
+
+
+class JSONArrayStream:
+    # walks a top-level JSON object and decodes the elements of one of its
+    # arrays a value at a time, only ever buffering the current element
+    def __init__(self, file, read_size: int = READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def __fill(self):
+        chunk = self.file.read(self.read_size)
+        if len(chunk) == 0:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def __peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON document")
+            self.__fill()
+
+    def __expect(self, chars: str):
+        char = self.__peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at '{char}'")
+        self.pos += 1
+        return char
+
+    def __value(self):
+        self.__peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the next read
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.__fill()
+
+    def iter_key(self, key: str):
+        self.__expect("{")
+        if self.__peek() == "}":
+            raise KeyError(key)
+        while True:
+            name = self.__value()
+            self.__expect(":")
+            if name != key:
+                self.__value()
+            else:
+                self.__expect("[")
+                if self.__peek() == "]":
+                    self.pos += 1
+                    return
+                while True:
+                    yield self.__value()
+                    if self.__expect(",]") == "]":
+                        return
+            if self.__expect(",}") == "}":
+                raise KeyError(key)
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_PATH = "./cache/query_embeddings.sqlite"
+
+
+def normalize_query(text: str) -> str:
+    # the tokenizer ignores runs of whitespace, so collapsing them never
+    # changes the embedding; case is kept since not every model is uncased
+    return " ".join(text.split())
+
+
+class QueryEmbeddingCache:
+    # query text -> embedding, an in-process LRU in front of an optional
+    # sqlite table that survives restarts; entries are keyed by model name
+    def __init__(self, model_name: str, size: int = QUERY_CACHE_SIZE, path: str | None = QUERY_CACHE_PATH):
+        self.model_name = model_name
+        self.size = size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        # shared by the search server's request threads
+        self.__lock = threading.Lock()
+        self.__db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT NOT NULL, query TEXT NOT NULL, embedding BLOB NOT NULL, "
+                "PRIMARY KEY (model, query))"
+            )
+            self.__db.commit()
+
+    def get(self, text: str):
+        key = normalize_query(text)
+        with self.__lock:
+            embedding = self.__entries.get(key)
+            if embedding is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return embedding.copy()
+            if self.__db is not None:
+                row = self.__db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+                    (self.model_name, key),
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self.__remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding.copy()
+            self.misses += 1
+            return None
+
+    def put_many(self, texts: list[str], embeddings):
+        keys = [normalize_query(text) for text in texts]
+        embeddings = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+        with self.__lock:
+            for key, embedding in zip(keys, embeddings):
+                self.__remember(key, embedding.copy())
+            if self.__db is not None:
+                self.__db.executemany(
+                    "INSERT OR REPLACE INTO query_embeddings (model, query, embedding) VALUES (?, ?, ?)",
+                    [(self.model_name, key, embedding.tobytes()) for key, embedding in zip(keys, embeddings)],
+                )
+                self.__db.commit()
+
+    def put(self, text: str, embedding):
+        self.put_many([text], [embedding])
+
+    def __remember(self, key: str, embedding: np.ndarray):
+        self.__entries[key] = embedding
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self.__entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            }
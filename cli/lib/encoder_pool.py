@@ -0,0 +1,53 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+worker_model = None
+
+
+def init_worker(model_name: str, threads: int):
+    # each worker gets its own model and a share of the cores, so the
+    # workers' torch thread pools don't oversubscribe the machine
+    global worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    worker_model = SentenceTransformer(model_name)
+
+
+def encode_slice(texts: list[str]) -> np.ndarray:
+    return worker_model.encode(texts)
+
+
+class EncoderPool:
+    # encode() has the same shape as SentenceTransformer.encode for a list
+    # of texts: the list is split across the workers and rows come back in
+    # input order
+    def __init__(self, model_name: str, workers: int, threads_per_worker: int | None = None):
+        self.workers = workers
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        # spawn, torch's thread pools don't survive a fork
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(model_name, threads),
+        )
+
+    def encode(self, texts: list[str], **kwargs) -> np.ndarray:
+        size = max(1, math.ceil(len(texts) / self.workers))
+        slices = [texts[start : start + size] for start in range(0, len(texts), size)]
+        return np.concatenate(list(self.executor.map(encode_slice, slices)))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
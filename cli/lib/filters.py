@@ -0,0 +1,227 @@
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+# fields with at most this many distinct values get a bitmap per value
+# (equality filters and facets); numeric fields also get a sorted column
+# for ranges, so high cardinality ones like id stay filterable
+BITMAP_MAX_VALUES = 256
+FILTER_PATTERN = re.compile(r"^\s*([A-Za-z_]\w*)\s*(!=|>=|<=|=|>|<)\s*(.*?)\s*$")
+# set bits per byte value, for counting packed bitmaps
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def parse_filter(expression: str):
+    # field=value, field=a|b (any of), field!=value, field=lo..hi
+    # (inclusive), field>=x, field<=x, field>x, field<x
+    match = FILTER_PATTERN.match(expression)
+    if match is None or len(match.group(3)) == 0:
+        raise ValueError(f"Invalid filter '{expression}', expected field=value, field=lo..hi or field>=value")
+    field, op, value = match.groups()
+    if op == "=" and ".." in value:
+        lo, hi = value.split("..", 1)
+        return field, "range", (lo.strip(), hi.strip())
+    if op in ("=", "!="):
+        return field, op, [v.strip() for v in value.split("|")]
+    return field, op, value
+
+
+def parse_filters(expressions: list[str] | None):
+    return [parse_filter(expression) for expression in expressions or []]
+
+
+def value_key(value) -> str:
+    # bitmap key of a document value, 1999 and 1999.0 are the same year
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).lower()
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class FilterIndex:
+    # precomputed per field indexes over a fixed list of documents;
+    # position i is documents[i], masks are bool arrays over positions.
+    # bitmaps[field] packs one row of bits per distinct value, columns[field]
+    # holds a numeric field's values (nan when missing) and their sort order
+    def __init__(self, doc_ids: np.ndarray, bitmaps: dict, columns: dict):
+        self.doc_ids = doc_ids
+        self.bitmaps = bitmaps
+        self.columns = columns
+        # doc id -> position, built on the first id lookup
+        self.__positions = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @property
+    def fields(self) -> list[str]:
+        return sorted(set(self.bitmaps) | set(self.columns))
+
+    @classmethod
+    def build(cls, documents):
+        documents = list(documents)
+        n = len(documents)
+        values_by_field = {}
+        for position, doc in enumerate(documents):
+            for field, value in doc.items():
+                values_by_field.setdefault(field, []).append((position, value))
+
+        bitmaps = {}
+        columns = {}
+        for field, values in values_by_field.items():
+            # list fields (say genres) index every element
+            if all(is_number(value) for _, value in values):
+                column = np.full(n, np.nan)
+                for position, value in values:
+                    column[position] = value
+                columns[field] = (column, np.argsort(column, kind="stable"))
+            positions_by_key = {}
+            for position, value in values:
+                for element in value if isinstance(value, list) else [value]:
+                    positions_by_key.setdefault(value_key(element), []).append(position)
+            if len(positions_by_key) > BITMAP_MAX_VALUES:
+                continue
+            keys = sorted(positions_by_key)
+            bits = np.zeros((len(keys), n), dtype=bool)
+            for row, key in enumerate(keys):
+                bits[row, positions_by_key[key]] = True
+            bitmaps[field] = (keys, np.packbits(bits, axis=1))
+        return cls(np.array([doc.get("id") for doc in documents], dtype=np.int64), bitmaps, columns)
+
+    def mask(self, filters) -> np.ndarray:
+        # bool mask of the documents passing every filter
+        packed = np.packbits(np.ones(len(self), dtype=bool))
+        for field, op, value in filters:
+            packed &= self.__packed_clause(field, op, value)
+        return np.unpackbits(packed, count=len(self)).astype(bool)
+
+    def __packed_clause(self, field: str, op: str, value):
+        if field not in self.bitmaps and field not in self.columns:
+            raise ValueError(f"Unknown filter field '{field}', expected one of {', '.join(self.fields)}")
+        if field in self.columns:
+            column, order = self.columns[field]
+            sorted_column = column[order]
+            # nans sort last and never match
+            valid = len(column) - int(np.isnan(column).sum())
+            match op:
+                case "=" | "!=":
+                    mask = np.zeros(len(self), dtype=bool)
+                    for v in value:
+                        number = parse_number(field, v)
+                        lo = np.searchsorted(sorted_column[:valid], number, "left")
+                        hi = np.searchsorted(sorted_column[:valid], number, "right")
+                        mask[order[lo:hi]] = True
+                    if op == "!=":
+                        mask = ~mask
+                    return np.packbits(mask)
+                case "range":
+                    lo, hi = parse_number(field, value[0]), parse_number(field, value[1])
+                case ">=":
+                    lo, hi = parse_number(field, value), math.inf
+                case ">":
+                    lo, hi = np.nextafter(parse_number(field, value), math.inf), math.inf
+                case "<=":
+                    lo, hi = -math.inf, parse_number(field, value)
+                case "<":
+                    lo, hi = -math.inf, np.nextafter(parse_number(field, value), -math.inf)
+            start = np.searchsorted(sorted_column[:valid], lo, "left")
+            end = np.searchsorted(sorted_column[:valid], hi, "right")
+            mask = np.zeros(len(self), dtype=bool)
+            mask[order[start:end]] = True
+            return np.packbits(mask)
+
+        if op not in ("=", "!="):
+            raise ValueError(f"Filter field '{field}' is not numeric, only = and != are supported")
+        keys, bits = self.bitmaps[field]
+        packed = np.zeros(bits.shape[1], dtype=np.uint8)
+        for v in value:
+            key = value_key(v)
+            row = np.searchsorted(keys, key)
+            if row < len(keys) and keys[row] == key:
+                packed |= bits[row]
+        if op == "!=":
+            # the padding bits past the last document are cleared by unpackbits(count=...)
+            packed = ~packed
+        return packed
+
+    def facets(self, mask: np.ndarray | None, fields: list[str] | None = None) -> dict:
+        # {field: {value: documents in mask}}, most common first; fields
+        # default to every bitmap field
+        if fields is None or len(fields) == 0:
+            fields = sorted(self.bitmaps)
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        packed = np.packbits(mask)
+        facets = {}
+        for field in fields:
+            if field not in self.bitmaps:
+                raise ValueError(f"Field '{field}' has no facets, expected one of {', '.join(sorted(self.bitmaps))}")
+            keys, bits = self.bitmaps[field]
+            counts = POPCOUNT[bits & packed].sum(axis=1)
+            ranked = sorted((-int(count), key) for key, count in zip(keys, counts) if count > 0)
+            facets[field] = {key: -count for count, key in ranked}
+        return facets
+
+    def id_mask(self, doc_ids) -> np.ndarray:
+        return np.isin(self.doc_ids, np.fromiter(doc_ids, dtype=np.int64))
+
+    def id_lookup(self, mask: np.ndarray):
+        # the mask looked up by doc id, for posting lists that only carry
+        # doc ids; ids can be sparse or huge, so they go through a position
+        # map shared by every mask instead of an array sized by the largest
+        if self.__positions is None:
+            self.__positions = {doc_id: i for i, doc_id in enumerate(self.doc_ids.tolist())}
+        return IdLookup(self.__positions, mask)
+
+    def save(self, path: str):
+        arrays = {"doc_ids": self.doc_ids}
+        meta = {"bitmaps": {}, "columns": []}
+        for i, (field, (keys, bits)) in enumerate(self.bitmaps.items()):
+            meta["bitmaps"][field] = keys
+            arrays[f"bitmap_{i}"] = bits
+        for i, (field, (column, order)) in enumerate(self.columns.items()):
+            meta["columns"].append(field)
+            arrays[f"column_{i}"] = column
+            arrays[f"order_{i}"] = order
+        arrays["meta"] = np.array(json.dumps(meta))
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            bitmaps = {field: (keys, data[f"bitmap_{i}"]) for i, (field, keys) in enumerate(meta["bitmaps"].items())}
+            columns = {field: (data[f"column_{i}"], data[f"order_{i}"]) for i, field in enumerate(meta["columns"])}
+            return cls(data["doc_ids"], bitmaps, columns)
+
+
+class IdLookup:
+    # lookup[doc_id] is 1 when that document passes the mask
+    def __init__(self, positions: dict, mask: np.ndarray):
+        self.positions = positions
+        self.passing = mask.astype(np.uint8).tobytes()
+
+    def __getitem__(self, doc_id: int) -> int:
+        return self.passing[self.positions[doc_id]]
+
+
+def parse_number(field: str, value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Filter field '{field}' is numeric, got '{value}'")
+
+
+def print_facets(facets: dict):
+    print()
+    for field, counts in facets.items():
+        print(f"{field}: {", ".join(f"{value} ({count})" for value, count in counts.items())}")
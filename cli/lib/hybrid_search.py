@@ -1,86 +1,201 @@
-import os
+import heapq
+import sys
+import threading
+import time
 
+from . import tracing
+from .ann import DEFAULT_NPROBE
 from .keyword_search import InvertedIndex
 from .semantic_search import ChunkedSemanticSearch
 
 
+class Leg:
+    # one retrieval leg on its own daemon thread, so concurrent queries
+    # never queue behind each other's legs; a leg that outlives its timeout
+    # is abandoned, it neither blocks a later query nor the process exit
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        self.start_time = time.monotonic()
+        self.started.set()
+        try:
+            self.result = self.fn()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # the timeout counts from when the leg started running
+        self.started.wait()
+        remaining = None if timeout is None else max(0.0, self.start_time + timeout - time.monotonic())
+        if not self.finished.wait(remaining):
+            raise TimeoutError
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, ann=False, nprobe=DEFAULT_NPROBE, quantization="float32", concurrent=False, leg_timeout=None):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
+        self.semantic_search = ChunkedSemanticSearch(quantization=quantization)
         self.semantic_search.load_or_create_chunked_embeddings(documents)
+        # semantic leg options, the IVF index is loaded up front when used
+        self.ann = ann
+        self.nprobe = nprobe
+        if ann:
+            self.semantic_search.load_or_create_ann()
 
         self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
+        if not self.idx.exists():
             self.idx.build()
             self.idx.save()
+        # load once, the segment is memory mapped and shared by every query
+        self.idx.load()
+
+        # with concurrent legs, keyword and semantic retrieval run side by
+        # side (NumPy and torch release the GIL); a leg still running
+        # leg_timeout seconds after it started is fused as if it found nothing
+        self.concurrent = concurrent
+        self.leg_timeout = leg_timeout
+
+    def rrf_search(self, query, limit, k, candidates=None, filters=None, facets=None):
+        # each leg retrieves `candidates` results (default `limit`), deeper
+        # pools find more documents both legs agree on; filters are applied
+        # inside both legs before scoring
+        depth = candidates or limit
+        bm25_results, semantic_results = self.__run_legs(
+            lambda: self._bm25_search(query, depth, filters),
+            lambda: self.semantic_search.search_chunks(query, depth, self.ann, self.nprobe, filters),
+            {},
+            [],
+        )
+        return self.__with_facets(self.__rrf_fuse(bm25_results, semantic_results, k, limit), filters, facets)
+
+    def rrf_search_batch(self, queries, limit, k, candidates=None):
+        depth = candidates or limit
+        bm25_results, semantic_results = self.__run_legs(
+            lambda: self._bm25_search_batch(queries, depth),
+            lambda: self.semantic_search.search_chunks_batch(queries, depth, self.ann, self.nprobe),
+            [{} for _ in queries],
+            [[] for _ in queries],
+        )
+        return [self.__rrf_fuse(b, s, k, limit) for b, s in zip(bm25_results, semantic_results)]
+
+    def __with_facets(self, results, filters, facets):
+        if facets is None:
+            return results
+        # the semantic leg matches every movie, so counts cover all movies passing the filters
+        filter_index = self.semantic_search.filter_index()
+        return results, filter_index.facets(filter_index.mask(filters) if filters else None, facets)
+
+    def __run_legs(self, keyword_leg, semantic_leg, keyword_fallback, semantic_fallback):
+        with tracing.stage("hybrid.legs"):
+            if not self.concurrent:
+                return keyword_leg(), semantic_leg()
+
+            legs = [Leg(keyword_leg).start(), Leg(semantic_leg).start()]
+            results = []
+            for name, leg, fallback in zip(("keyword", "semantic"), legs, (keyword_fallback, semantic_fallback)):
+                try:
+                    results.append(leg.wait(self.leg_timeout))
+                except TimeoutError:
+                    print(f"WARNING: {name} search timed out after {self.leg_timeout}s, using partial results", file=sys.stderr)
+                    results.append(fallback)
+            return results
+
+    def __rrf_fuse(self, bm25_results, semantic_results, k, limit):
+        bm25_ids = list(bm25_results.keys())
+        semantic_ids = [result["id"] for result in semantic_results]
+        tracing.count("hybrid.candidates", len(bm25_ids) + len(semantic_ids))
+        with tracing.stage("hybrid.fuse"):
+            fused = fuse_top_k(
+                [bm25_ids, semantic_ids],
+                [lambda rank: 1 / (k + rank + 1), lambda rank: 1 / (k + rank + 1)],
+                limit,
+            )
 
-    def rrf_search(self, query, limit, k):
-        bm25_results = self._bm25_search(query, limit)
-        semantic_results = self.semantic_search.search_chunks(query, limit)
         scores = {}
-        counter = 0
-        for doc_id, keyword_result in bm25_results.items():
-            counter += 1
-            if doc_id in scores:
-                scores[doc_id]["bm25_rank"] = counter
-            else:
-                scores[doc_id] = {"bm25_rank": counter, "semantic_rank": 0, "score": 0.0}
-
-        counter = 0
-        for semantic_result in semantic_results:
-            counter += 1 
-            if semantic_result["id"] in scores:
-                scores[semantic_result["id"]]["semantic_rank"] = counter
-            else:
-                scores[semantic_result["id"]] = {"semantic_rank": counter, "bm25_rank": 0, "score": 0.0}
-
-        for key, value in scores.items():
+        for doc_id, (bm25_rank, semantic_rank) in fused:
             score = 0
-            if scores[key]["semantic_rank"] > 0:
-                score += 1 / (k + value["semantic_rank"])
-            if scores[key]["bm25_rank"] > 0:
-                score += 1 / (k + value["bm25_rank"])
-
-            scores[key]["score"] = score
-            scores[key]["document"] = self.semantic_search.document_map[key]
-        
-        sorted_scores = dict(sorted(scores.items(), key=lambda item: item[1]["score"], reverse=True))
-        return sorted_scores
-
-    def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+            if semantic_rank is not None:
+                score += 1 / (k + semantic_rank + 1)
+            if bm25_rank is not None:
+                score += 1 / (k + bm25_rank + 1)
+            scores[doc_id] = {
+                "bm25_rank": 0 if bm25_rank is None else bm25_rank + 1,
+                "semantic_rank": 0 if semantic_rank is None else semantic_rank + 1,
+                "score": score,
+                "document": self.semantic_search.document_map[doc_id],
+            }
+        return scores
 
-    def weighted_search(self, query, alpha=0.5, limit=5):
-        # limit = limit * 500
-        bm25_results = self._bm25_search(query, limit)
-        semantic_results = self.semantic_search.search_chunks(query, limit)
-        normalized_bm25_scores = normalize_scores({id: result["score"] for id, result in bm25_results.items()})
-        normalized_semantic_scores = normalize_scores({result["id"]: result["score"] for result in semantic_results})
+    # legs are not padded with zero scoring movies, which would otherwise
+    # earn rrf credit just for filling out a deep pool
+    def _bm25_search(self, query, limit, filters=None, facets=None):
+        return self.idx.bm25_search(query, limit, filters, facets, pad=False)
 
-        scores = {}
-        for doc_id, keyword_score in normalized_bm25_scores.items():
-            if doc_id in scores:
-                scores[doc_id]["bm25"] = keyword_score
-            else:
-                scores[doc_id] = {"bm25": keyword_score, "semantic": 0.0, "hybrid": 0.0}
+    def _bm25_search_batch(self, queries, limit):
+        return self.idx.bm25_search_batch(queries, limit, pad=False)
 
-        for doc_id, semantic_score in normalized_semantic_scores.items():
-            if doc_id in scores:
-                scores[doc_id]["semantic"] = semantic_score
-            else:
-                scores[doc_id] = {"bm25": 0.0, "semantic": semantic_score, "hybrid": 0.0}
-        
-        for key, value in scores.items():
-            scores[key]["hybrid"] = self.hybrid_score(value["bm25"], value["semantic"], alpha)
-            scores[key]["document"] = self.semantic_search.document_map[key]
+    def weighted_search(self, query, alpha=0.5, limit=5, candidates=None, filters=None, facets=None):
+        depth = candidates or limit
+        bm25_results, semantic_results = self.__run_legs(
+            lambda: self._bm25_search(query, depth, filters),
+            lambda: self.semantic_search.search_chunks(query, depth, self.ann, self.nprobe, filters),
+            {},
+            [],
+        )
+        return self.__with_facets(self.__weighted_fuse(bm25_results, semantic_results, alpha, limit), filters, facets)
 
-        sorted_scores = dict(sorted(scores.items(), key=lambda item: item[1]["hybrid"], reverse=True))
-        return sorted_scores
-            
+    def weighted_search_batch(self, queries, alpha=0.5, limit=5, candidates=None):
+        depth = candidates or limit
+        bm25_results, semantic_results = self.__run_legs(
+            lambda: self._bm25_search_batch(queries, depth),
+            lambda: self.semantic_search.search_chunks_batch(queries, depth, self.ann, self.nprobe),
+            [{} for _ in queries],
+            [[] for _ in queries],
+        )
+        return [self.__weighted_fuse(b, s, alpha, limit) for b, s in zip(bm25_results, semantic_results)]
 
+    def __weighted_fuse(self, bm25_results, semantic_results, alpha, limit):
+        with tracing.stage("hybrid.normalize"):
+            normalized_bm25_scores = list(normalize_scores({id: result["score"] for id, result in bm25_results.items()}).items())
+            normalized_semantic_scores = list(normalize_scores({result["id"]: result["score"] for result in semantic_results}).items())
+        tracing.count("hybrid.candidates", len(normalized_bm25_scores) + len(normalized_semantic_scores))
+        with tracing.stage("hybrid.fuse"):
+            fused = fuse_top_k(
+                [[doc_id for doc_id, _ in normalized_bm25_scores], [doc_id for doc_id, _ in normalized_semantic_scores]],
+                [
+                    lambda rank: self.hybrid_score(normalized_bm25_scores[rank][1], 0.0, alpha),
+                    lambda rank: self.hybrid_score(0.0, normalized_semantic_scores[rank][1], alpha),
+                ],
+                limit,
+            )
 
+        scores = {}
+        for doc_id, (bm25_rank, semantic_rank) in fused:
+            bm25_score = 0.0 if bm25_rank is None else normalized_bm25_scores[bm25_rank][1]
+            semantic_score = 0.0 if semantic_rank is None else normalized_semantic_scores[semantic_rank][1]
+            scores[doc_id] = {
+                "bm25": bm25_score,
+                "semantic": semantic_score,
+                "hybrid": self.hybrid_score(bm25_score, semantic_score, alpha),
+                "document": self.semantic_search.document_map[doc_id],
+            }
+        return scores
 
     # def rrf_search(self, query, k, limit=10):
     #     raise NotImplementedError("RRF hybrid search is not implemented yet.")
@@ -89,6 +204,8 @@ class HybridSearch:
         return alpha * bm25_score + (1 - alpha) * semantic_score
 
 def normalize_scores(doc_scores):
+    if len(doc_scores) == 0:
+        return {}
     min_score = min(doc_scores.values())
     max_score = max(doc_scores.values())
     if min_score == max_score:
@@ -96,4 +213,53 @@ def normalize_scores(doc_scores):
     return {
         id: (score - min_score) / (max_score - min_score) if max_score > min_score else 0.0
         for id, score in doc_scores.items()
-    }
\ No newline at end of file
+    }
+
+
+def fuse_top_k(ranked_lists, contributions, limit):
+    # threshold algorithm over ranked id lists: walks all lists one rank at
+    # a time, scoring each newly seen id exactly (its rank in every list,
+    # contributions[i](rank) for list i, nothing when absent). Any id not
+    # seen yet ranks deeper in every list, so it scores at most the sum of
+    # the next ranks' contributions; once the limit-th best score beats
+    # that the top `limit` is final. contributions must not increase with
+    # rank. Returns (id, ranks) best first, ranks holds None where absent;
+    # ties keep the order of the first list an id appears in, then rank.
+    if limit <= 0:
+        return []
+    # id -> rank of each list, indexed only as deep as a lookup has needed
+    positions = [{} for _ in ranked_lists]
+    indexed = [0] * len(ranked_lists)
+
+    def rank_in(i, doc_id):
+        ids = ranked_lists[i]
+        ranks_by_id = positions[i]
+        while doc_id not in ranks_by_id and indexed[i] < len(ids):
+            ranks_by_id[ids[indexed[i]]] = indexed[i]
+            indexed[i] += 1
+        return ranks_by_id.get(doc_id)
+
+    heap = []
+    seen = set()
+    depth = 0
+    while any(depth < len(ids) for ids in ranked_lists):
+        for ids in ranked_lists:
+            if depth >= len(ids) or ids[depth] in seen:
+                continue
+            doc_id = ids[depth]
+            seen.add(doc_id)
+            ranks = [rank_in(i, doc_id) for i in range(len(ranked_lists))]
+            score = sum(contribution(rank) for contribution, rank in zip(contributions, ranks) if rank is not None)
+            # the heap root is the worst kept entry, lowest score then latest in tie order
+            first_list = next(i for i, rank in enumerate(ranks) if rank is not None)
+            entry = (score, -first_list, -ranks[first_list], doc_id, ranks)
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            elif entry[:3] > heap[0][:3]:
+                heapq.heapreplace(heap, entry)
+        depth += 1
+        threshold = sum(contribution(depth) for contribution, ids in zip(contributions, ranked_lists) if depth < len(ids))
+        # strictly above, an unseen id could still tie and win on order
+        if len(heap) >= limit and heap[0][0] > threshold:
+            break
+    return [(entry[3], entry[4]) for entry in sorted(heap, key=lambda entry: entry[:3], reverse=True)]
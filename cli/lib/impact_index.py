@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+
+# impacts are quantized to 1..IMPACT_LEVELS (12 bits, stored as uint16), a
+# query score is a sum of them; 8 bits lost too many near ties in the top 10
+IMPACT_LEVELS = 4095
+
+
+class ImpactIndex:
+    # BM25 contributions precomputed for one (k1, b) and linearly quantized
+    # to small integers; each term's postings are stored highest impact
+    # first. Built from a segment's stored tfs and doc lengths, so new
+    # parameters never need the documents re-tokenized.
+    def __init__(self, k1: float, b: float, scale: float, term_offsets: np.ndarray, doc_positions: np.ndarray, impacts: np.ndarray):
+        self.k1 = k1
+        self.b = b
+        # score = sum of impacts * scale
+        self.scale = scale
+        self.term_offsets = term_offsets
+        self.doc_positions = doc_positions
+        self.impacts = impacts
+
+    @classmethod
+    def build(cls, segment, k1: float, b: float):
+        doc_positions, tfs = segment.posting_arrays()
+        doc_freqs = np.asarray(segment.doc_freqs, dtype=np.int64)
+        term_offsets = np.zeros(len(doc_freqs) + 1, dtype=np.int64)
+        np.cumsum(doc_freqs, out=term_offsets[1:])
+
+        # same formulas as InvertedIndex.get_bm25_idf / get_bm25_tf, for every posting at once
+        n = segment.meta["doc_count"]
+        idf = np.log((n - doc_freqs + 0.5) / (doc_freqs + 0.5) + 1)
+        doc_lengths = np.asarray(segment.doc_lengths, dtype=np.float64)
+        avg_doc_length = segment.avg_doc_length
+        length_norm = 1 - b + b * (doc_lengths / avg_doc_length) if avg_doc_length > 0 else np.ones_like(doc_lengths)
+        tfs = np.asarray(tfs, dtype=np.float64)
+        contributions = np.repeat(idf, doc_freqs) * ((tfs * (k1 + 1)) / (tfs + k1 * length_norm[doc_positions]))
+
+        scale = float(contributions.max()) / IMPACT_LEVELS if len(contributions) > 0 else 1.0
+        if scale == 0:
+            scale = 1.0
+        # every match counts for at least 1 so no posting quantizes away
+        impacts = np.clip(np.rint(contributions / scale), 1, IMPACT_LEVELS).astype(np.uint16)
+
+        # impact order within each term, ties by doc position
+        term_ids = np.repeat(np.arange(len(doc_freqs)), doc_freqs)
+        order = np.lexsort((doc_positions, -impacts.astype(np.int32), term_ids))
+        return cls(k1, b, scale, term_offsets, np.asarray(doc_positions, dtype=np.int32)[order], impacts[order])
+
+    def scores(self, term_ids: list[int], n_docs: int) -> np.ndarray:
+        # integer score of every doc position, a term listed twice counts twice
+        scores = np.zeros(n_docs, dtype=np.int32)
+        for term_id in term_ids:
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            # a term has at most one posting per document, so this is a plain scatter-add
+            scores[self.doc_positions[start:end]] += self.impacts[start:end]
+        return scores
+
+    @staticmethod
+    def path_for(segment_path: str, k1: float, b: float) -> str:
+        # kept inside the segment directory, so rewriting the segment drops it
+        return os.path.join(segment_path, f"impacts_k1={k1}_b={b}.npz")
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array([self.k1, self.b, self.scale]),
+                term_offsets=self.term_offsets,
+                doc_positions=self.doc_positions,
+                impacts=self.impacts,
+            )
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            k1, b, scale = data["params"].tolist()
+            return cls(k1, b, scale, data["term_offsets"], data["doc_positions"], data["impacts"])
+
+    @classmethod
+    def load_or_create(cls, segment, k1: float, b: float):
+        path = cls.path_for(segment.path, k1, b)
+        impact_index = cls.load(path)
+        if impact_index is None:
+            impact_index = cls.build(segment, k1, b)
+            impact_index.save(path)
+        return impact_index
@@ -1,124 +1,339 @@
+import bisect
+import heapq
 import json
 import math
 import pickle
 import os
-import string
-from typing import Counter
-from nltk.stem import PorterStemmer
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, chain
+
+import numpy as np
+
+from .documents import batched, document_hash, iter_documents
+from .filters import FilterIndex, IdLookup
+from .impact_index import ImpactIndex
+from . import tracing
+from .segment import Segment, SegmentDocLengths, SegmentDocMap, SegmentIndex, write_segment
+from .tokenizer import Tokenizer
 
 BM25_K1 = 1.5
 BM25_B = 0.75
-stopwords = []
+# relative slack on the top-k threshold when pruning with max impacts
+PRUNE_SLACK = 1e-9
+LEGACY_INDEX_PATH = "./cache/index.pkl"
+BUILD_BATCH_SIZE = 1000
+# batches queued per build worker so a slow one doesn't stall the pool
+BUILD_BATCHES_IN_FLIGHT = 2
+# smaller corpora are built serially whatever the worker count: each worker
+# starts an interpreter and imports nltk (about a second), and unpickling and
+# merging its partial indexes costs the main process ~0.1ms a movie against
+# ~0.15ms to tokenize one, which also caps the speedup near 1.5x. Measured:
+# 3k movies 1.3s serial, 2.3s with 2 workers; 20k about break even
+PARALLEL_BUILD_MIN_DOCUMENTS = 20000
+# per field bitmaps of the segment's documents, kept in the segment directory
+FILTER_INDEX_FILE = "filters.npz"
+tokenizer = None
 
 class InvertedIndex:
-    index = {}
-    docmap = {}
-    term_frequencies = {}
-    doc_lengths = {}
-    index_path = "./cache/index.pkl"
+    index_path = "./cache/segment"
 
     def __init__(self):
-        pass
+        # per instance, a shard or benchmark index in the same process
+        # must not share postings with the main one
+        self.index = {}
+        self.docmap = {}
+        self.doc_lengths = {}
+        # surface word -> stem of the indexed text, collected while
+        # tokenizing and saved as the segment's stem table
+        self.stems = {}
+        self.__avg_doc_length = None
+        self.__idf_cache = {}
+        self.__max_impact_cache = {}
+        # set while the index is served from a loaded segment
+        self.__segment = None
+        self.__impact_indexes = {}
+        self.__filter_index = None
+        # (doc_count, avg_doc_length, doc_freqs) of the whole corpus when
+        # this index only holds a shard of it
+        self.__global_stats = None
 
     def __add_document(self, doc_id: int, text: str):
-        tokens = tokenize(text)
-        for token in tokens:
+        return self.__add_tokens(doc_id, get_tokenizer().tokenize(text, self.stems))
+
+    def __add_tokens(self, doc_id: int, tokens: list[str]):
+        # postings are (doc_id, tf, positions) tuples, built in one pass
+        # over the document's tokens
+        positions = {}
+        for position, token in enumerate(tokens):
+            if token in positions:
+                positions[token].append(position)
+            else:
+                positions[token] = [position]
+
+        for token, token_positions in positions.items():
+            posting = (doc_id, len(token_positions), token_positions)
             if token in self.index:
-                if doc_id not in self.index[token]:
-                    self.index[token].append(doc_id)
+                self.index[token].append(posting)
             else:
-                self.index[token] = [doc_id]
+                self.index[token] = [posting]
 
         self.doc_lengths[doc_id] = len(tokens)
+        self.__reset_stats()
+        return positions.keys()
 
-        counter = Counter(tokens)
-        if doc_id not in self.term_frequencies:
-            self.term_frequencies[doc_id] = counter
-        else:
-            self.term_frequencies[doc_id].update(counter)
+    def __reset_stats(self):
+        self.__avg_doc_length = None
+        self.__idf_cache = {}
+        self.__max_impact_cache = {}
+        self.__filter_index = None
+
+    def set_global_stats(self, doc_count: int, avg_doc_length: float, doc_freqs: dict):
+        # score with corpus wide N, avgdl and df instead of this index's own,
+        # so a shard's BM25 scores are the ones the unsharded index gives
+        self.__global_stats = (doc_count, avg_doc_length, doc_freqs)
+        self.__reset_stats()
 
     def __get_avg_doc_length(self):
+        if self.__global_stats is not None:
+            return self.__global_stats[1]
+        # avgdl only changes when documents are added, so compute it once
+        if self.__avg_doc_length is not None:
+            return self.__avg_doc_length
         doc_lengths = self.doc_lengths.values()
         if len(doc_lengths) == 0:
             return 0.0
         total = sum(doc_lengths)
-        # total = map(lambda x, y: x + y, doc_lengths)
-        return total / len(doc_lengths) 
+        self.__avg_doc_length = total / len(doc_lengths)
+        return self.__avg_doc_length
+
+    def __get_term_idf(self, token: str):
+        # same formula as get_bm25_idf, but for an already tokenized term
+        if token not in self.__idf_cache:
+            n = len(self.docmap)
+            df = len(self.index.get(token, []))
+            if self.__global_stats is not None:
+                n = self.__global_stats[0]
+                df = self.__global_stats[2].get(token, df)
+            self.__idf_cache[token] = math.log((n - df + 0.5) / (df + 0.5) + 1)
+        return self.__idf_cache[token]
+
+    def __get_max_impact(self, token: str, k1 = BM25_K1, b = BM25_B):
+        # upper bound of the token's contribution to any document's score,
+        # read from the segment when it was stored for these parameters
+        key = (token, k1, b)
+        if key not in self.__max_impact_cache:
+            impact = None
+            if self.__segment is not None:
+                impact = self.__segment.max_impact(token, k1, b)
+            if impact is None:
+                impact = max(self.__term_contributions(token, k1, b).values(), default=0.0)
+            self.__max_impact_cache[key] = impact
+        return self.__max_impact_cache[key]
 
     def get_tf(self, doc_id: int, term: str):
         tokens = tokenize(term)
         if len(tokens) > 1:
             raise("ERROR: can only get term frequency of single terms")
-        if doc_id not in self.term_frequencies:
-            return 0
-        tf = self.term_frequencies[doc_id]
-        if tokens[0] not in tf:
+        posting = self.__find_posting(tokens[0], doc_id)
+        if posting is None:
             return 0
-        return tf[tokens[0]]
+        return posting[1]
+
+    def __find_posting(self, token: str, doc_id: int):
+        # posting lists are sorted by doc_id
+        postings = self.index.get(token, [])
+        i = bisect.bisect_left(postings, doc_id, key=lambda posting: posting[0])
+        if i < len(postings) and postings[i][0] == doc_id:
+            return postings[i]
+        return None
 
     def get_documents(self, term: str):
         term = term.lower()
         if term in self.index:
-            ids = self.index[term]
-            ids.sort()
-            return ids
+            return [posting[0] for posting in self.index[term]]
         return []
 
-    def build(self):
-        with open("./data/movies.json", "r") as file:
-            data = json.load(file)
-            if "movies" not in data:
-                print("ERROR: Key 'movies' not found in dictionary")
-                return
-            movies = data.get("movies")
+    def build(self, workers: int = 1, path: str | None = None):
+        # movies are streamed in batches, the whole file is never parsed at once
+        batches = batched(self.__checked(iter_documents(path)), BUILD_BATCH_SIZE)
+        # read ahead far enough to tell whether workers pay off; a missing
+        # "movies" key fails on the first batch
+        head = []
+        buffered = 0
+        try:
+            for batch in batches:
+                head.append(batch)
+                buffered += len(batch)
+                if workers <= 1 or buffered >= PARALLEL_BUILD_MIN_DOCUMENTS:
+                    break
+        except KeyError:
+            print("ERROR: Key 'movies' not found in dictionary")
+            return
+        batches = chain(head, batches)
+
+        if workers <= 1 or buffered < PARALLEL_BUILD_MIN_DOCUMENTS:
+            indexed = 0
+            for batch in batches:
+                self.add_documents(batch)
+                indexed += len(batch)
+                print(f"{indexed} movies", end='\r')
+        else:
+            # batches are contiguous in document order and merged back in
+            # order, so postings come out exactly as in a serial build;
+            # only a few batches are in flight to keep memory bounded
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                merged = 0
+                for batch in batches:
+                    for movie in batch:
+                        self.docmap[movie.get("id")] = movie
+                    pending.append(executor.submit(build_partial_index, batch))
+                    if len(pending) >= workers * BUILD_BATCHES_IN_FLIGHT:
+                        self.__merge_partial(*pending.popleft().result())
+                        merged += 1
+                        print(f"{merged} batches", end='\r')
+                while pending:
+                    self.__merge_partial(*pending.popleft().result())
+                    merged += 1
+                    print(f"{merged} batches", end='\r')
+            self.__reset_stats()
+
+        for postings in self.index.values():
+            postings.sort(key=lambda posting: posting[0])
 
-        total = len(movies)
-        for index, movie in enumerate(movies):
+    def __checked(self, movies):
+        for movie in movies:
             if "title" not in movie:
                 print("ERROR: Key 'title' not found in dictionary")
             if "description" not in movie:
                 print("ERROR: Key 'description' not found in dictionary")
             if "id" not in movie:
                 print("ERROR: Key 'id' not found in dictionary")
-            title = movie.get("title")
-            description = movie.get("description")
-            id = movie.get("id")
+            yield movie
 
-            print(f"{index+1}/{total}", end='\r')
-            self.__add_document(id, f"{title} {description}")
-            self.docmap[id] = movie
+    def __merge_partial(self, index, doc_lengths, stems):
+        for token, postings in index.items():
+            if token in self.index:
+                self.index[token].extend(postings)
+            else:
+                self.index[token] = postings
+        self.doc_lengths.update(doc_lengths)
+        self.stems.update(stems)
+
+    def add_documents(self, movies: list[dict]):
+        all_tokens = tokenize_many((f"{movie.get("title")} {movie.get("description")}" for movie in movies), self.stems)
+        for movie, tokens in zip(movies, all_tokens):
+            self.__add_tokens(movie.get("id"), tokens)
+            self.docmap[movie.get("id")] = movie
     
+    def update(self, documents: list[dict]):
+        # only added, changed and deleted documents are tokenized, every
+        # other posting is carried over from the saved index
+        if self.exists():
+            self.load()
+        if self.__segment is not None:
+            self.stems = dict(self.__segment.stem_items())
+        self.__segment = None
+        self.index = {term: list(postings) for term, postings in self.index.items()}
+        self.docmap = dict(self.docmap.items())
+        self.doc_lengths = dict(self.doc_lengths.items())
+
+        new_docs = {movie.get("id"): movie for movie in documents}
+        deleted = [doc_id for doc_id in self.docmap if doc_id not in new_docs]
+        updated = [
+            doc_id for doc_id, movie in new_docs.items()
+            if doc_id in self.docmap and document_hash(self.docmap[doc_id]) != document_hash(movie)
+        ]
+        added = [doc_id for doc_id in new_docs if doc_id not in self.docmap]
+
+        touched = set()
+        for doc_id in deleted + updated:
+            old_movie = self.docmap.pop(doc_id)
+            del self.doc_lengths[doc_id]
+            for token in set(tokenize(f"{old_movie.get("title")} {old_movie.get("description")}")):
+                self.index[token] = [posting for posting in self.index.get(token, []) if posting[0] != doc_id]
+                touched.add(token)
+        for doc_id in updated + added:
+            movie = new_docs[doc_id]
+            touched.update(self.__add_document(doc_id, f"{movie.get("title")} {movie.get("description")}"))
+            self.docmap[doc_id] = movie
+
+        for token in touched:
+            if len(self.index[token]) == 0:
+                del self.index[token]
+            else:
+                self.index[token].sort(key=lambda posting: posting[0])
+        self.__reset_stats()
+        return {"added": len(added), "updated": len(updated), "deleted": len(deleted)}
+
     def save(self):
         if not os.path.isdir("./cache"):
             os.mkdir("./cache")
+        max_impacts = {token: self.__get_max_impact(token) for token in self.index}
+        # nothing is collected for pickles migrated with positional postings,
+        # their segment gets no stem table and queries use the stemmer
+        write_segment(self.index_path, self.index, self.docmap, self.doc_lengths, max_impacts, (BM25_K1, BM25_B), self.stems or None)
+        self.filter_index().save(os.path.join(self.index_path, FILTER_INDEX_FILE))
+
+    def filter_index(self):
+        # bitmaps over the documents in doc id order, loaded from the
+        # segment or built from the docmap on first use
+        if self.__filter_index is None:
+            if self.__segment is not None:
+                self.__filter_index = FilterIndex.load(os.path.join(self.__segment.path, FILTER_INDEX_FILE))
+            if self.__filter_index is None:
+                self.__filter_index = FilterIndex.build(self.docmap[doc_id] for doc_id in sorted(self.docmap))
+        return self.__filter_index
+
+    def exists(self):
+        return os.path.isdir(self.index_path) or os.path.exists(LEGACY_INDEX_PATH)
 
-        with open(self.index_path, "wb") as f1:
-            pickle.dump(self.index, f1)
-        with open("./cache/docmap.pkl", "wb") as f2:
-            pickle.dump(self.docmap, f2)
-        with open("./cache/term_frequencies.pkl", "wb") as f3:
-            pickle.dump(self.term_frequencies, f3)
-        with open("./cache/doc_lengths.pkl", "wb") as f4:
-            pickle.dump(self.doc_lengths, f4)
-    
     def load(self):
-        if not os.path.exists(self.index_path):
-            raise("ERROR: ./cache/index.pkl does not exist")
+        if not os.path.isdir(self.index_path):
+            # caches written before the segment format
+            self.load_pickles()
+            return
+
+        # the segment is memory mapped, postings and documents are only
+        # read (and decoded) when a query touches them
+        segment = Segment(self.index_path)
+        self.index = SegmentIndex(segment)
+        self.docmap = SegmentDocMap(segment)
+        self.doc_lengths = SegmentDocLengths(segment)
+        self.__segment = segment
+        self.__impact_indexes = {}
+        get_tokenizer().stem_lookup = segment.find_stem
+        self.__reset_stats()
+        self.__avg_doc_length = segment.avg_doc_length
+
+    def load_pickles(self):
+        if not os.path.exists(LEGACY_INDEX_PATH):
+            raise FileNotFoundError("./cache/index.pkl does not exist")
         if not os.path.exists("./cache/docmap.pkl"):
-            raise("ERROR: ./cache/docmap.pkl does not exist")
-        if not os.path.exists("./cache/term_frequencies.pkl"):
-            raise("ERROR: ./cache/term_frequencies.pkl does not exist")
+            raise FileNotFoundError("./cache/docmap.pkl does not exist")
         if not os.path.exists("./cache/doc_lengths.pkl"):
-            raise("ERROR: ./cache/doc_lengths.pkl does not exist")
+            raise FileNotFoundError("./cache/doc_lengths.pkl does not exist")
 
-        with open(self.index_path, "rb")as f1:
+        self.__segment = None
+        with open(LEGACY_INDEX_PATH, "rb")as f1:
             self.index = pickle.load(f1)
         with open("./cache/docmap.pkl", "rb")as f2:
             self.docmap = pickle.load(f2)
-        with open("./cache/term_frequencies.pkl", "rb")as f3:
-            self.term_frequencies = pickle.load(f3)
         with open("./cache/doc_lengths.pkl", "rb")as f4:
             self.doc_lengths = pickle.load(f4)
+
+        # the oldest caches stored bare doc ids (term frequencies in a
+        # separate pickle) and no positions; re-tokenize the documents so
+        # phrase and NEAR queries work on the migrated index
+        if any(isinstance(postings[0], int) for postings in self.index.values() if postings):
+            self.index = {}
+            self.doc_lengths = {}
+            self.add_documents(list(self.docmap.values()))
+            for postings in self.index.values():
+                postings.sort(key=lambda posting: posting[0])
+        self.__reset_stats()
     
     def get_bm25_idf(self, term: str):
         # N = total number of docs
@@ -149,45 +364,314 @@ class InvertedIndex:
         bm25tf = self.get_bm25_tf(doc_id, term)
         return bm25idf * bm25tf
 
-    def bm25_search(self, query: str, limit: int):
-        tokens = tokenize(query)
+    def __term_contributions(self, token: str, k1 = BM25_K1, b = BM25_B):
+        # doc_id -> BM25 contribution of one tokenized term
+        contributions = {}
+        if token not in self.index:
+            return contributions
+        avg_doc_length = self.__get_avg_doc_length()
+        idf = self.__get_term_idf(token)
+        for doc_id, tf, _ in self.index[token]:
+            length_norm = 1 - b + b * (self.doc_lengths[doc_id] / avg_doc_length)
+            contributions[doc_id] = idf * ((tf * (k1 + 1)) / (tf + k1 * length_norm))
+        return contributions
+
+    def bm25_scores(self, tokens: list[str], k1 = BM25_K1, b = BM25_B):
+        # term-at-a-time: only documents on the query terms' posting lists
+        # are touched, everything else keeps an implicit score of 0
         scores = {}
-        for movie in self.docmap.values():
+        for token in tokens:
+            for doc_id, contribution in self.__term_contributions(token, k1, b).items():
+                scores[doc_id] = scores.get(doc_id, 0) + contribution
+        return scores
+
+    def bm25_top_k(self, tokens: list[str], limit: int, k1 = BM25_K1, b = BM25_B, allowed: IdLookup | None = None):
+        # MaxScore document-at-a-time search. Terms are ordered by their max
+        # impact; once the heap holds `limit` documents, the low-impact
+        # terms whose bounds add up to no more than the k-th score are
+        # non-essential: documents only they contain are never visited, and
+        # they are only probed for a document while it can still make it.
+        # Returns [(doc_id, score)] equal to the head of a full ranking.
+        # With `allowed` (FilterIndex.id_lookup), only doc ids it marks are
+        # scored.
+        if limit <= 0:
+            return []
+        counts = {}
+        for token in tokens:
+            if token in self.index:
+                counts[token] = counts.get(token, 0) + 1
+        if len(counts) == 0:
+            return []
+
+        avg_doc_length = self.__get_avg_doc_length()
+        terms = sorted(counts, key=lambda token: self.__get_max_impact(token, k1, b) * counts[token])
+        postings = [self.index[token] for token in terms]
+        idfs = [self.__get_term_idf(token) for token in terms]
+        # bounds[i]: most that terms[0..i] can add to any score together
+        bounds = list(accumulate(self.__get_max_impact(token, k1, b) * counts[token] for token in terms))
+        cursors = [0] * len(terms)
+        heap = []
+        cutoff = -math.inf
+        first_essential = 0
+        visited = 0
+        pruned_count = 0
+
+        while True:
+            doc_id = None
+            for i in range(first_essential, len(terms)):
+                if allowed is not None:
+                    # filtered documents are stepped over, never scored, so
+                    # the max impact bounds stay valid
+                    while cursors[i] < len(postings[i]) and not allowed[postings[i][cursors[i]][0]]:
+                        cursors[i] += 1
+                if cursors[i] < len(postings[i]) and (doc_id is None or postings[i][cursors[i]][0] < doc_id):
+                    doc_id = postings[i][cursors[i]][0]
+            if doc_id is None:
+                break
+            visited += 1
+
+            length_norm = 1 - b + b * (self.doc_lengths[doc_id] / avg_doc_length)
+            contributions = {}
+            estimate = 0.0
+            for i in range(first_essential, len(terms)):
+                posting = postings[i][cursors[i]] if cursors[i] < len(postings[i]) else None
+                if posting is not None and posting[0] == doc_id:
+                    tf = posting[1]
+                    contributions[terms[i]] = idfs[i] * ((tf * (k1 + 1)) / (tf + k1 * length_norm))
+                    estimate += contributions[terms[i]] * counts[terms[i]]
+                    cursors[i] += 1
+
+            pruned = False
+            for i in range(first_essential - 1, -1, -1):
+                if estimate + bounds[i] <= cutoff:
+                    pruned = True
+                    break
+                j = bisect.bisect_left(postings[i], doc_id, lo=cursors[i], key=lambda posting: posting[0])
+                cursors[i] = j
+                if j < len(postings[i]) and postings[i][j][0] == doc_id:
+                    tf = postings[i][j][1]
+                    contributions[terms[i]] = idfs[i] * ((tf * (k1 + 1)) / (tf + k1 * length_norm))
+                    estimate += contributions[terms[i]] * counts[terms[i]]
+            if pruned:
+                pruned_count += 1
+                continue
+
+            # summed in query order so scores match bm25_scores exactly
             score = 0
             for token in tokens:
-                score += self.get_bm25(movie["id"], token)
-            scores[movie["id"]] = score
+                if token in contributions:
+                    score += contributions[token]
+            # the worst entry is the lowest score, then the highest doc id
+            entry = (score, -doc_id)
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            if len(heap) == limit:
+                # a little slack so float rounding in the bounds never prunes a tie
+                cutoff = heap[0][0] - abs(heap[0][0]) * PRUNE_SLACK
+                while first_essential < len(terms) and bounds[first_essential] <= cutoff:
+                    first_essential += 1
 
-        sorted_scores = dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+        if tracing.active is not None:
+            tracing.count("keyword.postings", sum(len(term_postings) for term_postings in postings))
+            tracing.count("keyword.documents_scored", visited - pruned_count)
+            tracing.count("keyword.documents_pruned", pruned_count)
+        return sorted(((-neg_doc_id, score) for score, neg_doc_id in heap), key=lambda item: (-item[1], item[0]))
+
+    def __rank(self, scores: dict, limit: int, pad: bool = True):
+        # heap selection, O(n log limit) instead of sorting every match
+        return self.__results(heapq.nsmallest(max(limit, 0), scores.items(), key=lambda item: (-item[1], item[0])), limit, pad=pad)
+
+    def __results(self, ranked: list, limit: int, allowed: IdLookup | None = None, pad: bool = True):
+        # the full scan used to return zero scoring documents when fewer
+        # than `limit` matched, keep doing that in docmap order; fusion
+        # turns pad off, a zero score is no evidence of relevance
+        if pad and len(ranked) < limit:
+            matched = {doc_id for doc_id, _ in ranked}
+            for doc_id in self.docmap:
+                if len(ranked) >= limit:
+                    break
+                if doc_id not in matched and (allowed is None or allowed[doc_id]):
+                    ranked.append((doc_id, 0))
 
         retval = {}
-        counter = 0
-        for key in sorted_scores:
-            if counter >= limit:
-                break
-            retval[key] = {"score": sorted_scores[key], "movie": self.docmap[key]}
-            counter += 1
+        for doc_id, score in ranked:
+            retval[doc_id] = {"score": score, "movie": self.docmap[doc_id]}
         return retval
 
+    def bm25_search(self, query: str, limit: int, filters=None, facets: list[str] | None = None, pad: bool = True):
+        # filters are parsed filter clauses (see filters.parse_filters);
+        # with facets (field names, empty for all) returns (results,
+        # facet counts over the matching documents that pass the filters)
+        mask = None
+        allowed = None
+        if filters:
+            with tracing.stage("keyword.filter"):
+                filter_index = self.filter_index()
+                mask = filter_index.mask(filters)
+                allowed = filter_index.id_lookup(mask)
+        with tracing.stage("keyword.tokenize"):
+            tokens = tokenize(query)
+        with tracing.stage("keyword.score"):
+            ranked = self.bm25_top_k(tokens, limit, allowed=allowed)
+        with tracing.stage("keyword.results"):
+            results = self.__results(ranked, limit, allowed, pad)
+        if facets is None:
+            return results
+        with tracing.stage("keyword.facets"):
+            matched = set()
+            for token in set(tokens):
+                if token in self.index:
+                    matched.update(posting[0] for posting in self.index[token])
+            filter_index = self.filter_index()
+            matched_mask = filter_index.id_mask(matched)
+            if mask is not None:
+                matched_mask &= mask
+            return results, filter_index.facets(matched_mask, facets)
+
+    def load_or_create_impacts(self, k1 = BM25_K1, b = BM25_B):
+        # built from the loaded segment's tfs and doc lengths on first use,
+        # one per (k1, b)
+        if self.__segment is None:
+            raise ValueError("Impact scores are built from a saved segment, load the index first")
+        if (k1, b) not in self.__impact_indexes:
+            self.__impact_indexes[(k1, b)] = ImpactIndex.load_or_create(self.__segment, k1, b)
+        return self.__impact_indexes[(k1, b)]
+
+    def impact_search(self, query: str, limit: int, k1 = BM25_K1, b = BM25_B):
+        # BM25 ranking from precomputed, quantized impacts: scoring is an
+        # integer scatter-add per query term, scores are approximate
+        impact_index = self.load_or_create_impacts(k1, b)
+        term_ids = [self.__segment.find_term(token) for token in tokenize(query)]
+        scores = impact_index.scores([term_id for term_id in term_ids if term_id >= 0], len(self.docmap))
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > limit > 0:
+            # keep everything tied with the k-th score, the sort below breaks ties
+            kth = np.partition(scores[candidates], len(candidates) - limit)[len(candidates) - limit]
+            candidates = candidates[scores[candidates] >= kth]
+        # doc positions follow doc id order, so ties break on doc id like __rank
+        ranked_positions = candidates[np.lexsort((candidates, -scores[candidates]))][:max(limit, 0)]
+        ranked = [
+            (int(self.__segment.doc_ids[position]), float(scores[position]) * impact_index.scale)
+            for position in ranked_positions
+        ]
+        return self.__results(ranked, limit)
+
+    def bm25_search_batch(self, queries: list[str], limit: int, pad: bool = True):
+        # each distinct term's posting list is walked once for the whole
+        # batch, queries then only sum the shared contributions
+        query_tokens = [tokenize(query) for query in queries]
+        contributions = {}
+        for tokens in query_tokens:
+            for token in tokens:
+                if token not in contributions:
+                    contributions[token] = self.__term_contributions(token)
+
+        results = []
+        for tokens in query_tokens:
+            scores = {}
+            for token in tokens:
+                for doc_id, contribution in contributions[token].items():
+                    scores[doc_id] = scores.get(doc_id, 0) + contribution
+            results.append(self.__rank(scores, limit, pad))
+        return results
+
+    def __phrase_matches(self, tokens: list[str]):
+        # doc_id -> start positions where tokens occur consecutively
+        postings = []
+        for token in tokens:
+            if token not in self.index:
+                return {}
+            postings.append({doc_id: positions for doc_id, _, positions in self.index[token]})
+
+        matches = {}
+        for doc_id in min(postings, key=len):
+            if not all(doc_id in p for p in postings):
+                continue
+            following = [set(p[doc_id]) for p in postings[1:]]
+            starts = [
+                start for start in postings[0][doc_id]
+                if all(start + i + 1 in positions for i, positions in enumerate(following))
+            ]
+            if starts:
+                matches[doc_id] = starts
+        return matches
+
+    def __near_matches(self, left: list[str], right: list[str], k: int):
+        left_matches = self.__phrase_matches(left)
+        right_matches = self.__phrase_matches(right)
+        matches = {}
+        for doc_id, left_starts in left_matches.items():
+            if doc_id not in right_matches:
+                continue
+            for l in left_starts:
+                for r in right_matches[doc_id]:
+                    # distance between the end of one side and the start of the other
+                    gap = r - (l + len(left) - 1) if l < r else l - (r + len(right) - 1)
+                    if 0 < gap <= k:
+                        matches[doc_id] = True
+                        break
+                if doc_id in matches:
+                    break
+        return matches
+
+    def positional_search(self, query: str, limit: int):
+        clauses = parse_positional_query(query)
+        if len(clauses) == 0:
+            return {}
+
+        doc_ids = None
+        query_tokens = []
+        for clause in clauses:
+            if clause[0] == "phrase":
+                matches = self.__phrase_matches(clause[1])
+                query_tokens += clause[1]
+            else:
+                matches = self.__near_matches(clause[1], clause[2], clause[3])
+                query_tokens += clause[1] + clause[2]
+            doc_ids = set(matches) if doc_ids is None else doc_ids & set(matches)
+
+        scores = self.bm25_scores(query_tokens)
+        ranked = sorted(((doc_id, scores[doc_id]) for doc_id in doc_ids), key=lambda item: (-item[1], item[0]))
+        retval = {}
+        for doc_id, score in ranked[:limit]:
+            retval[doc_id] = {"score": score, "movie": self.docmap[doc_id]}
+        return retval
+
+def parse_positional_query(query: str):
+    # "quoted phrases", bare terms and `left NEAR/k right`, all clauses must match
+    parts = re.findall(r'"[^"]*"|NEAR/\d+|\S+', query)
+    clauses = []
+    i = 0
+    while i < len(parts):
+        tokens = tokenize(parts[i].strip('"'))
+        if i + 2 < len(parts) and re.fullmatch(r"NEAR/\d+", parts[i + 1]):
+            right = tokenize(parts[i + 2].strip('"'))
+            if tokens and right:
+                clauses.append(("near", tokens, right, int(parts[i + 1][5:])))
+            i += 3
+            continue
+        if tokens:
+            clauses.append(("phrase", tokens))
+        i += 1
+    return clauses
+
+def build_partial_index(movies: list[dict]):
+    # runs in a build worker, returns the postings, doc lengths and stems of one shard
+    partial = InvertedIndex()
+    partial.add_documents(movies)
+    return partial.index, partial.doc_lengths, partial.stems
+
 def tokenize(search):
-    search = search.lower()
-    dict = {}
-    for punc in string.punctuation:
-        dict[punc] = None
-    table = str.maketrans(dict)
-    search = search.translate(table)
-    searchTerms = search.split()
-    searchTerms = [t for t in searchTerms if t not in get_stopwords()]
-    stemmer = PorterStemmer()
-    for index, st in enumerate(searchTerms):
-        searchTerms[index] = stemmer.stem(st)
-    return searchTerms
-
-def get_stopwords():
-    global stopwords
-    if len(stopwords) > 0:
-        return stopwords
-
-    with open("./data/stopwords.txt", "r") as stopwordsFile:
-        stopwords = stopwordsFile.read().splitlines()
-    return stopwords
\ No newline at end of file
+    return get_tokenizer().tokenize(search)
+
+def tokenize_many(texts, stems=None):
+    return get_tokenizer().tokenize_many(texts, stems)
+
+def get_tokenizer():
+    # built on first use, stopwords are read relative to the working directory
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = Tokenizer()
+    return tokenizer
\ No newline at end of file
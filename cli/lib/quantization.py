@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+
+QUANTIZATION_MODES = ("float32", "float16", "int8", "pq")
+# chunks re-scored at full precision after quantized scoring
+DEFAULT_RESCORE = 100
+PQ_SUBSPACE_DIM = 8
+PQ_CENTROIDS = 256
+PQ_TRAIN_SAMPLE = 50000
+PQ_ITERATIONS = 15
+# quantized rows are decoded in blocks so scoring never materializes a
+# full float32 copy of the matrix
+SCORE_BLOCK_SIZE = 16384
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = PQ_ITERATIONS, seed: int = 0):
+    # plain euclidean k-means, used to train the PQ codebooks
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+    return centroids.astype(np.float32)
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin ||v - c||^2 == argmax (v.c - ||c||^2 / 2)
+    half_norms = (centroids ** 2).sum(axis=1) / 2
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCORE_BLOCK_SIZE):
+        block = vectors[start : start + SCORE_BLOCK_SIZE]
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T - half_norms, axis=1)
+    return assignments
+
+
+class QuantizedEmbeddings:
+    # compressed copy of an L2-normalized embedding matrix, scores are
+    # approximate dot products with a normalized query
+    def __init__(self, mode: str, arrays: dict):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode '{mode}', expected one of {', '.join(QUANTIZATION_MODES)}")
+        self.mode = mode
+        self.arrays = arrays
+
+    @classmethod
+    def build(cls, normalized: np.ndarray, mode: str, seed: int = 0):
+        match mode:
+            case "float32":
+                arrays = {"data": np.asarray(normalized, dtype=np.float32)}
+            case "float16":
+                arrays = {"data": normalized.astype(np.float16)}
+            case "int8":
+                # symmetric per-dimension scale so every column uses the full int8 range
+                scale = np.abs(normalized).max(axis=0) / 127
+                scale[scale == 0] = 1.0
+                codes = np.clip(np.rint(normalized / scale), -127, 127).astype(np.int8)
+                arrays = {"data": codes, "scale": scale.astype(np.float32)}
+            case "pq":
+                n, dim = normalized.shape
+                if dim % PQ_SUBSPACE_DIM != 0:
+                    raise ValueError(f"Embedding dimension {dim} is not a multiple of {PQ_SUBSPACE_DIM}")
+                m = dim // PQ_SUBSPACE_DIM
+                rng = np.random.default_rng(seed)
+                sample = normalized[rng.choice(n, size=min(n, PQ_TRAIN_SAMPLE), replace=False)]
+                codebooks = np.empty((m, min(PQ_CENTROIDS, len(sample)), PQ_SUBSPACE_DIM), dtype=np.float32)
+                codes = np.empty((n, m), dtype=np.uint8)
+                for j in range(m):
+                    sub = slice(j * PQ_SUBSPACE_DIM, (j + 1) * PQ_SUBSPACE_DIM)
+                    codebooks[j] = kmeans(sample[:, sub], PQ_CENTROIDS, seed=seed + j)
+                    codes[:, j] = nearest_centroids(normalized[:, sub], codebooks[j])
+                arrays = {"data": codes, "codebooks": codebooks}
+            case _:
+                raise ValueError(f"Unknown quantization mode '{mode}', expected one of {', '.join(QUANTIZATION_MODES)}")
+        return cls(mode, arrays)
+
+    def __len__(self):
+        return len(self.arrays["data"])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def score(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        data = self.arrays["data"]
+        n = len(data) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        lookup = None
+        if self.mode == "pq":
+            # asymmetric distance: the query stays float, each code is a
+            # lookup into a per-subspace table of query.centroid products
+            codebooks = self.arrays["codebooks"]
+            sub_queries = query.reshape(len(codebooks), PQ_SUBSPACE_DIM)
+            lookup = np.einsum("mkd,md->mk", codebooks, sub_queries)
+            subspaces = np.arange(len(codebooks))
+        elif self.mode == "int8":
+            query = query * self.arrays["scale"]
+
+        for start in range(0, n, SCORE_BLOCK_SIZE):
+            block_rows = slice(start, start + SCORE_BLOCK_SIZE) if rows is None else rows[start : start + SCORE_BLOCK_SIZE]
+            block = data[block_rows]
+            if lookup is not None:
+                scores[start : start + len(block)] = lookup[subspaces, block].sum(axis=1)
+            else:
+                scores[start : start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, mode=np.array(self.mode), **self.arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files if key != "mode"}
+            return cls(str(data["mode"]), arrays)
+
+
+def rescore(quantized: QuantizedEmbeddings, embeddings: np.ndarray, query: np.ndarray, depth: int, rows: np.ndarray | None = None):
+    # approximate scores from the codes pick `depth` candidates, which are
+    # then scored against the full precision rows; returns (rows, scores)
+    approx = quantized.score(query, rows)
+    if depth <= 0:
+        return (np.arange(len(approx)) if rows is None else rows), approx
+    k = min(depth, len(approx))
+    best = np.argpartition(-approx, k - 1)[:k] if k < len(approx) else np.arange(len(approx))
+    candidates = np.sort(best if rows is None else rows[best])
+    full = np.asarray(embeddings[candidates], dtype=np.float32)
+    norms = np.linalg.norm(full, axis=1)
+    norms[norms == 0] = 1.0
+    return candidates, (full @ query) / norms
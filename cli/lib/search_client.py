@@ -0,0 +1,43 @@
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# kept free of model/index imports so thin clients start fast
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def remote_search(url: str, mode: str, query: str, limit: int = 5, k: int = 60, alpha: float = 0.5, candidates: int | None = None,
+                  filters: list[str] | None = None, facets: list[str] | None = None):
+    # filters are unparsed expressions; with facets returns (results, facets)
+    # like the local searches, an empty list asks for every faceted field
+    params = {"mode": mode, "q": query, "limit": limit, "k": k, "alpha": alpha}
+    if candidates is not None:
+        params["candidates"] = candidates
+    params = list(params.items()) + [("filter", expression) for expression in filters or []]
+    if facets is not None:
+        params += [("facet", field) for field in facets or ["*"]]
+    params = urllib.parse.urlencode(params)
+    body = fetch_json(f"{url.rstrip('/')}/search?{params}")
+    if facets is not None:
+        return body["results"], body["facets"]
+    return body["results"]
+
+
+def remote_stats(url: str):
+    return fetch_json(f"{url.rstrip('/')}/stats")
+
+
+def fetch_json(url: str):
+    # the server answers errors with {"error": message}, raised here as
+    # ValueError like the same mistake made locally
+    try:
+        with urllib.request.urlopen(url) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.load(e)["error"]
+        except (ValueError, KeyError, TypeError):
+            message = e.reason
+        raise ValueError(f"{message} (HTTP {e.code})")
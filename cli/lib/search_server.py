@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+import urllib.parse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .ann import DEFAULT_NPROBE
+from .filters import parse_filters
+from .hybrid_search import HybridSearch
+from .search_client import DEFAULT_HOST, DEFAULT_PORT
+
+LATENCY_WINDOW = 10000
+SEARCH_MODES = ("keyword", "semantic", "rrf", "weighted")
+
+
+class SearchService:
+    # one warm HybridSearch shared by every request thread; everything it
+    # holds is read-only once loaded
+    def __init__(self, documents, ann=False, nprobe=DEFAULT_NPROBE, quantization="float32", concurrent=False, leg_timeout=None):
+        self.hybrid_search = HybridSearch(documents, ann, nprobe, quantization, concurrent, leg_timeout)
+        self.started = time.time()
+        self.__lock = threading.Lock()
+        self.__latencies = {mode: deque(maxlen=LATENCY_WINDOW) for mode in SEARCH_MODES}
+        self.__counts = {mode: 0 for mode in SEARCH_MODES}
+        self.__errors = 0
+
+    def search(self, mode: str, query: str, limit: int = 5, k: int = 60, alpha: float = 0.5, candidates: int | None = None, filters=None, facets=None):
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {', '.join(SEARCH_MODES)}")
+        start = time.perf_counter()
+        try:
+            match mode:
+                case "keyword":
+                    # padded like keyword_search_cli.py bm25search, not like the hybrid leg
+                    results = self.hybrid_search.idx.bm25_search(query, limit, filters, facets)
+                case "semantic":
+                    results = self.hybrid_search.semantic_search.search_chunks(
+                        query, limit, self.hybrid_search.ann, self.hybrid_search.nprobe, filters, facets
+                    )
+                case "rrf":
+                    results = self.hybrid_search.rrf_search(query, limit, k, candidates, filters, facets)
+                case "weighted":
+                    results = self.hybrid_search.weighted_search(query, alpha, limit, candidates, filters, facets)
+        except Exception:
+            with self.__lock:
+                self.__errors += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self.__lock:
+            self.__latencies[mode].append(elapsed)
+            self.__counts[mode] += 1
+        return results
+
+    def stats(self):
+        with self.__lock:
+            latencies = {mode: list(values) for mode, values in self.__latencies.items()}
+            counts = dict(self.__counts)
+            errors = self.__errors
+
+        modes = {}
+        for mode, values in latencies.items():
+            if len(values) == 0:
+                modes[mode] = {"count": counts[mode]}
+                continue
+            values_ms = np.array(values) * 1000
+            modes[mode] = {
+                "count": counts[mode],
+                "mean_ms": float(values_ms.mean()),
+                "p50_ms": float(np.percentile(values_ms, 50)),
+                "p95_ms": float(np.percentile(values_ms, 95)),
+                "p99_ms": float(np.percentile(values_ms, 99)),
+                "max_ms": float(values_ms.max()),
+            }
+        return {
+            "uptime_s": time.time() - self.started,
+            "errors": errors,
+            "modes": modes,
+            "query_cache": self.hybrid_search.semantic_search.query_cache.stats(),
+        }
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    service: SearchService = None
+
+    def do_GET(self):
+        try:
+            self.__route()
+        except Exception as e:
+            # an unexpected failure still answers instead of dropping the connection
+            self.__send(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def __route(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        match url.path:
+            case "/health":
+                self.__send(200, {"status": "ok"})
+            case "/stats":
+                self.__send(200, self.service.stats())
+            case "/search":
+                # facet=* asks for every faceted field
+                facets = None
+                if "facet" in params:
+                    facets = [field for field in params["facet"] if field != "*"]
+                try:
+                    results = self.service.search(
+                        params.get("mode", ["rrf"])[0],
+                        required_param(params, "q"),
+                        limit=number_param(params, "limit", int, 5, minimum=1),
+                        k=number_param(params, "k", int, 60, minimum=1),
+                        alpha=number_param(params, "alpha", float, 0.5),
+                        candidates=number_param(params, "candidates", int, None, minimum=1),
+                        filters=parse_filters(params.get("filter")),
+                        facets=facets,
+                    )
+                except ValueError as e:
+                    self.__send(400, {"error": str(e)})
+                    return
+                if facets is None:
+                    self.__send(200, {"results": results})
+                else:
+                    self.__send(200, {"results": results[0], "facets": results[1]})
+            case _:
+                self.__send(404, {"error": f"Unknown path {url.path}"})
+
+    def __send(self, status: int, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # request latency is tracked in /stats, keep stderr quiet
+        pass
+
+
+def required_param(params: dict, name: str) -> str:
+    # parse_qs drops blank values, so q= is missing too
+    values = params.get(name)
+    if not values or values[0].strip() == "":
+        raise ValueError(f"missing query parameter {name}")
+    return values[0]
+
+
+def number_param(params: dict, name: str, cast, default, minimum=None):
+    if name not in params:
+        return default
+    value = params[name][0]
+    try:
+        number = cast(value)
+    except ValueError:
+        raise ValueError(f"query parameter {name} must be {"an integer" if cast is int else "a number"}, got '{value}'")
+    if minimum is not None and number < minimum:
+        raise ValueError(f"query parameter {name} must be at least {minimum}, got {number}")
+    return number
+
+
+def serve(documents, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, ann: bool = False, nprobe: int = DEFAULT_NPROBE, quantization: str = "float32", concurrent: bool = False, leg_timeout: float | None = None):
+    service = SearchService(documents, ann, nprobe, quantization, concurrent, leg_timeout)
+    handler = type("BoundSearchRequestHandler", (SearchRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving search on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
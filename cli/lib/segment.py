@@ -0,0 +1,346 @@
+import json
+import mmap
+import os
+import shutil
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+
+# On-disk layout of an index segment directory:
+#   meta.json             doc count, total token count, format version
+#   terms.bin             sorted terms, utf-8, concatenated
+#   term_offsets.npy      uint64[T+1] byte offsets into terms.bin
+#   postings.bin          varint postings, per term: (doc_id delta, tf, n_positions, position deltas...)*
+#   postings_offsets.npy  uint64[T+1] byte offsets into postings.bin
+#   doc_freqs.npy         uint32[T]
+#   doc_ids.npy           int64[N] sorted doc ids
+#   doc_lengths.npy       int32[N] token count per doc, same order as doc_ids
+#   docs.bin              json encoded documents, same order as doc_ids
+#   doc_offsets.npy       uint64[N+1] byte offsets into docs.bin
+#   posting_docs.npy      int32[P] doc position (into doc_ids) of every posting, in term order
+#   posting_tfs.npy       uint32[P] tf of every posting, same order
+#   max_impacts.npy       float64[T] highest BM25 contribution of each term, for
+#                         the (k1, b) recorded in meta.json; optional
+#   stem_words.bin        sorted surface words of the indexed text, utf-8,
+#                         concatenated; optional, like the three below
+#   stem_word_offsets.npy uint64[W+1] byte offsets into stem_words.bin
+#   stems.bin             stem of each surface word, empty when it is the word
+#   stem_offsets.npy      uint64[W+1] byte offsets into stems.bin
+SEGMENT_VERSION = 1
+POSTINGS_CACHE_SIZE = 4096
+
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_postings(buf, start: int, end: int):
+    # returns a list of (doc_id, tf, positions) tuples
+    postings = []
+    values = []
+    value = 0
+    shift = 0
+    for byte in buf[start:end]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = 0
+        shift = 0
+
+    i = 0
+    doc_id = 0
+    while i < len(values):
+        doc_id += values[i]
+        tf = values[i + 1]
+        n_positions = values[i + 2]
+        positions = []
+        position = 0
+        for delta in values[i + 3 : i + 3 + n_positions]:
+            position += delta
+            positions.append(position)
+        postings.append((doc_id, tf, positions))
+        i += 3 + n_positions
+    return postings
+
+
+def write_segment(path: str, index, docmap, doc_lengths, max_impacts=None, impact_params=None, stems=None):
+    tmp_path = f"{path}.tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    terms = sorted(index)
+    doc_ids = np.array(sorted(docmap), dtype=np.int64)
+    doc_positions = {doc_id: i for i, doc_id in enumerate(doc_ids.tolist())}
+    posting_docs = []
+    posting_tfs = []
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    postings_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    doc_freqs = np.zeros(len(terms), dtype=np.uint32)
+    with open(os.path.join(tmp_path, "terms.bin"), "wb") as terms_file, \
+            open(os.path.join(tmp_path, "postings.bin"), "wb") as postings_file:
+        term_offset = 0
+        postings_offset = 0
+        for i, term in enumerate(terms):
+            encoded_term = term.encode("utf-8")
+            terms_file.write(encoded_term)
+            term_offset += len(encoded_term)
+            term_offsets[i + 1] = term_offset
+
+            buf = bytearray()
+            last_doc_id = 0
+            postings = index[term]
+            for doc_id, tf, positions in postings:
+                posting_docs.append(doc_positions[doc_id])
+                posting_tfs.append(tf)
+                encode_varint(doc_id - last_doc_id, buf)
+                encode_varint(tf, buf)
+                # pickles migrated from before positional postings have none
+                encode_varint(len(positions), buf)
+                last_position = 0
+                for position in positions:
+                    encode_varint(position - last_position, buf)
+                    last_position = position
+                last_doc_id = doc_id
+            postings_file.write(buf)
+            postings_offset += len(buf)
+            postings_offsets[i + 1] = postings_offset
+            doc_freqs[i] = len(postings)
+
+    lengths = np.array([doc_lengths[doc_id] for doc_id in doc_ids.tolist()], dtype=np.int32)
+    doc_offsets = np.zeros(len(doc_ids) + 1, dtype=np.uint64)
+    with open(os.path.join(tmp_path, "docs.bin"), "wb") as docs_file:
+        offset = 0
+        for i, doc_id in enumerate(doc_ids.tolist()):
+            encoded_doc = json.dumps(docmap[doc_id]).encode("utf-8")
+            docs_file.write(encoded_doc)
+            offset += len(encoded_doc)
+            doc_offsets[i + 1] = offset
+
+    np.save(os.path.join(tmp_path, "term_offsets.npy"), term_offsets)
+    np.save(os.path.join(tmp_path, "postings_offsets.npy"), postings_offsets)
+    np.save(os.path.join(tmp_path, "doc_freqs.npy"), doc_freqs)
+    np.save(os.path.join(tmp_path, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(tmp_path, "doc_lengths.npy"), lengths)
+    np.save(os.path.join(tmp_path, "doc_offsets.npy"), doc_offsets)
+    np.save(os.path.join(tmp_path, "posting_docs.npy"), np.array(posting_docs, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "posting_tfs.npy"), np.array(posting_tfs, dtype=np.uint32))
+    meta = {
+        "version": SEGMENT_VERSION,
+        "doc_count": len(doc_ids),
+        "term_count": len(terms),
+        "total_length": int(lengths.sum()),
+    }
+    if max_impacts is not None:
+        np.save(os.path.join(tmp_path, "max_impacts.npy"), np.array([max_impacts[term] for term in terms], dtype=np.float64))
+        meta["impact_k1"], meta["impact_b"] = impact_params
+    if stems is not None:
+        # surface word -> stem of the indexed text, lets queries skip the stemmer
+        words = sorted(stems)
+        write_strings(os.path.join(tmp_path, "stem_words.bin"), os.path.join(tmp_path, "stem_word_offsets.npy"), words)
+        write_strings(
+            os.path.join(tmp_path, "stems.bin"),
+            os.path.join(tmp_path, "stem_offsets.npy"),
+            ["" if stems[word] == word else stems[word] for word in words],
+        )
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def write_strings(path: str, offsets_path: str, strings: list[str]):
+    offsets = np.zeros(len(strings) + 1, dtype=np.uint64)
+    with open(path, "wb") as f:
+        offset = 0
+        for i, value in enumerate(strings):
+            encoded = value.encode("utf-8")
+            f.write(encoded)
+            offset += len(encoded)
+            offsets[i + 1] = offset
+    np.save(offsets_path, offsets)
+
+
+def find_string(buf, offsets, count: int, key: bytes) -> int:
+    # binary search over count sorted, concatenated strings; -1 when absent
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if buf[int(offsets[mid]):int(offsets[mid + 1])] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < count and buf[int(offsets[lo]):int(offsets[lo + 1])] == key:
+        return lo
+    return -1
+
+
+def _map_file(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != SEGMENT_VERSION:
+            raise ValueError(f"Unsupported segment version in {path}")
+
+        # everything is mapped, nothing is read until a query touches it
+        self.terms = _map_file(os.path.join(path, "terms.bin"))
+        self.postings = _map_file(os.path.join(path, "postings.bin"))
+        self.docs = _map_file(os.path.join(path, "docs.bin"))
+        self.term_offsets = np.load(os.path.join(path, "term_offsets.npy"), mmap_mode="r")
+        self.postings_offsets = np.load(os.path.join(path, "postings_offsets.npy"), mmap_mode="r")
+        self.doc_freqs = np.load(os.path.join(path, "doc_freqs.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode="r")
+        self.doc_offsets = np.load(os.path.join(path, "doc_offsets.npy"), mmap_mode="r")
+        # segments written before impact bounds and flat postings were
+        # stored don't have them
+        self.max_impacts = None
+        if os.path.exists(os.path.join(path, "max_impacts.npy")):
+            self.max_impacts = np.load(os.path.join(path, "max_impacts.npy"), mmap_mode="r")
+        self.posting_docs = None
+        self.posting_tfs = None
+        if os.path.exists(os.path.join(path, "posting_tfs.npy")):
+            self.posting_docs = np.load(os.path.join(path, "posting_docs.npy"), mmap_mode="r")
+            self.posting_tfs = np.load(os.path.join(path, "posting_tfs.npy"), mmap_mode="r")
+        # and before the stem table was
+        self.stem_count = 0
+        if os.path.exists(os.path.join(path, "stem_offsets.npy")):
+            self.stem_words = _map_file(os.path.join(path, "stem_words.bin"))
+            self.stem_word_offsets = np.load(os.path.join(path, "stem_word_offsets.npy"), mmap_mode="r")
+            self.stems = _map_file(os.path.join(path, "stems.bin"))
+            self.stem_offsets = np.load(os.path.join(path, "stem_offsets.npy"), mmap_mode="r")
+            self.stem_count = len(self.stem_offsets) - 1
+
+    def find_stem(self, word: str) -> str | None:
+        # the stem the build gave an indexed surface word, None for words
+        # the indexed text doesn't contain
+        if self.stem_count == 0:
+            return None
+        i = find_string(self.stem_words, self.stem_word_offsets, self.stem_count, word.encode("utf-8"))
+        if i < 0:
+            return None
+        stem = self.stems[int(self.stem_offsets[i]):int(self.stem_offsets[i + 1])].decode("utf-8")
+        return stem or word
+
+    def stem_items(self):
+        for i in range(self.stem_count):
+            word = self.stem_words[int(self.stem_word_offsets[i]):int(self.stem_word_offsets[i + 1])].decode("utf-8")
+            stem = self.stems[int(self.stem_offsets[i]):int(self.stem_offsets[i + 1])].decode("utf-8")
+            yield word, stem or word
+
+    @property
+    def avg_doc_length(self):
+        if self.meta["doc_count"] == 0:
+            return 0.0
+        return self.meta["total_length"] / self.meta["doc_count"]
+
+    def term_at(self, i: int):
+        return self.terms[int(self.term_offsets[i]):int(self.term_offsets[i + 1])].decode("utf-8")
+
+    def find_term(self, term: str):
+        # binary search over the sorted term dictionary
+        return find_string(self.terms, self.term_offsets, self.meta["term_count"], term.encode("utf-8"))
+
+    def max_impact(self, term: str, k1: float, b: float):
+        # None when no bound was stored for these parameters
+        if self.max_impacts is None or (self.meta.get("impact_k1"), self.meta.get("impact_b")) != (k1, b):
+            return None
+        i = self.find_term(term)
+        if i < 0:
+            return 0.0
+        return float(self.max_impacts[i])
+
+    def postings_at(self, i: int):
+        return decode_postings(self.postings, int(self.postings_offsets[i]), int(self.postings_offsets[i + 1]))
+
+    def posting_arrays(self):
+        # (doc positions, tfs) of every posting in term order, term i's
+        # postings start at the sum of the doc_freqs before it
+        if self.posting_tfs is not None:
+            return self.posting_docs, self.posting_tfs
+        doc_ids = []
+        tfs = []
+        for i in range(self.meta["term_count"]):
+            for doc_id, tf, _ in self.postings_at(i):
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        doc_positions = np.searchsorted(self.doc_ids, np.array(doc_ids, dtype=np.int64))
+        return doc_positions.astype(np.int32), np.array(tfs, dtype=np.uint32)
+
+    def doc_position(self, doc_id: int):
+        i = int(np.searchsorted(self.doc_ids, doc_id))
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return -1
+
+    def doc_at(self, i: int):
+        return json.loads(self.docs[int(self.doc_offsets[i]):int(self.doc_offsets[i + 1])])
+
+
+# term -> postings view over a segment, posting lists are decoded on access
+class SegmentIndex(Mapping):
+    def __init__(self, segment: Segment):
+        self.segment = segment
+        self.__postings = lru_cache(maxsize=POSTINGS_CACHE_SIZE)(segment.postings_at)
+
+    def __getitem__(self, term):
+        i = self.segment.find_term(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.__postings(i)
+
+    def __contains__(self, term):
+        return self.segment.find_term(term) >= 0
+
+    def __iter__(self):
+        for i in range(self.segment.meta["term_count"]):
+            yield self.segment.term_at(i)
+
+    def __len__(self):
+        return self.segment.meta["term_count"]
+
+
+# doc_id -> document view over a segment
+class SegmentDocMap(Mapping):
+    def __init__(self, segment: Segment):
+        self.segment = segment
+
+    def __getitem__(self, doc_id):
+        i = self.segment.doc_position(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.segment.doc_at(i)
+
+    def __contains__(self, doc_id):
+        return self.segment.doc_position(doc_id) >= 0
+
+    def __iter__(self):
+        return iter(self.segment.doc_ids.tolist())
+
+    def __len__(self):
+        return self.segment.meta["doc_count"]
+
+
+# doc_id -> token count view over a segment
+class SegmentDocLengths(SegmentDocMap):
+    def __getitem__(self, doc_id):
+        i = self.segment.doc_position(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return int(self.segment.doc_lengths[i])
@@ -1,34 +1,166 @@
+import glob
 import json
 import os
 import re
-from sentence_transformers import SentenceTransformer
+import threading
+import time
+from contextlib import nullcontext
+from itertools import islice
 import numpy as np
 
+from .chunk_metadata import CHUNK_METADATA_FILE, LEGACY_CHUNK_METADATA_FILE, ChunkMetadata
+from .documents import batched, load_documents, text_hash
+from . import tracing
+from .embedding_cache import QUERY_CACHE_PATH, QueryEmbeddingCache
+from .encoder_pool import EncoderPool
+from .filters import FilterIndex
+from .ann import DEFAULT_NPROBE, IVFIndex, recall_at_k
+from .quantization import DEFAULT_RESCORE, QUANTIZATION_MODES, QuantizedEmbeddings, rescore
+
+# texts handed to the model per encode call while building, also the
+# checkpoint interval of a chunk build
+ENCODE_BATCH_SIZE = 1024
+CHUNK_PARTIAL_FILE = "chunk_embeddings.partial.npy"
+CHUNK_CHECKPOINT_FILE = "chunk_build.json"
+
+
 class SemanticSearch:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        self.model: SentenceTransformer = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantization="float32", rescore=DEFAULT_RESCORE, query_cache_path=QUERY_CACHE_PATH, encode_workers=1):
+        self.model_name = model_name
+        # with more than one worker, builds encode on a pool of processes
+        self.encode_workers = encode_workers
+        # loaded on first encode, importing sentence_transformers (torch)
+        # takes seconds and cached queries never need it
+        self.__model = None
+        self.__model_lock = threading.Lock()
+        # repeated queries skip the forward pass, pass None to keep it in memory only
+        self.query_cache = QueryEmbeddingCache(model_name, path=query_cache_path)
         self.embeddings = None
+        self.normalized_embeddings = None
+        # with a quantized mode only the codes stay in memory, the float32
+        # rows are memory mapped and read back for rescoring
+        self.quantization = quantization
+        self.rescore = rescore
+        self.quantized_embeddings = None
         self.documents = None
         self.document_map = {}
-        self.model: SentenceTransformer
+
+    @property
+    def model(self):
+        with self.__model_lock:
+            if self.__model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self.__model = SentenceTransformer(self.model_name)
+            return self.__model
     
     def generate_embeddings(self, text: str):
         text = text.strip()
         if len(text) == 0:
             raise ValueError("Cannot generate embedding for an empty string")
-        embeddings = self.model.encode(text)
+        with tracing.stage("semantic.query_cache"):
+            embeddings = self.query_cache.get(text)
+        if embeddings is None:
+            tracing.count("semantic.query_cache_misses")
+            # the first encode loads the model
+            with tracing.stage("semantic.load_model"):
+                model = self.model
+            with tracing.stage("semantic.encode"):
+                embeddings = model.encode(text)
+            self.query_cache.put(text, embeddings)
+        else:
+            tracing.count("semantic.query_cache_hits")
         return embeddings
+
+    def generate_embeddings_batch(self, texts: list[str]):
+        texts = [text.strip() for text in texts]
+        if any(len(text) == 0 for text in texts):
+            raise ValueError("Cannot generate embedding for an empty string")
+        cached = [self.query_cache.get(text) for text in texts]
+        missing = [i for i, embedding in enumerate(cached) if embedding is None]
+        if len(missing) > 0:
+            # one encode call so the model batches the forward passes
+            encoded = self.model.encode([texts[i] for i in missing])
+            self.query_cache.put_many([texts[i] for i in missing], encoded)
+            for i, embedding in zip(missing, encoded):
+                cached[i] = embedding
+        return np.array(cached, dtype=np.float32)
     
+    def encoder(self):
+        # context manager around whatever encodes corpus texts, queries
+        # always use the in-process model
+        if self.encode_workers <= 1:
+            return nullcontext(self.model)
+        return EncoderPool(self.model_name, self.encode_workers)
+
     def build_embeddings(self, documents):
+        self.documents = documents
+        for doc in documents:
+            self.document_map[doc["id"]] = doc
+        documents_str = (f"{doc['title']}: {doc['description']}" for doc in documents)
+        hashes = []
+        embeddings = []
+        # texts are produced and encoded a batch at a time
+        with self.encoder() as encoder:
+            for batch in batched(documents_str, ENCODE_BATCH_SIZE):
+                hashes += [text_hash(text) for text in batch]
+                embeddings.append(encoder.encode(batch, show_progress_bar=True))
+        self.embeddings = np.concatenate(embeddings) if len(embeddings) > 0 else np.empty((0, 0), dtype=np.float32)
+        self.__save_embeddings(hashes)
+        self.__prepare_embeddings()
+        return self.embeddings
+
+    def update_embeddings(self, documents):
+        # vectors only depend on the embedded text, so rows are reused by
+        # text hash and only new or edited documents are encoded
         self.documents = documents
         documents_str = []
         for doc in documents:
             self.document_map[doc["id"]] = doc
             documents_str.append(f"{doc['title']}: {doc['description']}")
-        self.embeddings = self.model.encode(documents_str, show_progress_bar=True)
+        hashes = [text_hash(text) for text in documents_str]
+
+        old_embeddings = None
+        old_rows = {}
+        if os.path.exists("cache/movie_embeddings.npy") and os.path.exists("cache/movie_embeddings_hashes.json"):
+            old_embeddings = np.load("cache/movie_embeddings.npy", mmap_mode="r")
+            with open("cache/movie_embeddings_hashes.json", "r") as f:
+                old_hashes = json.load(f)["hashes"]
+            if len(old_hashes) == len(old_embeddings):
+                old_rows = {h: row for row, h in enumerate(old_hashes)}
+
+        missing = [i for i, h in enumerate(hashes) if h not in old_rows]
+        reused = [i for i, h in enumerate(hashes) if h in old_rows]
+        if len(reused) == 0:
+            return self.build_embeddings(documents)
+        embeddings = np.empty((len(documents), old_embeddings.shape[1]), dtype=np.float32)
+        embeddings[reused] = old_embeddings[[old_rows[hashes[i]] for i in reused]]
+        if len(missing) > 0:
+            with self.encoder() as encoder:
+                embeddings[missing] = encoder.encode([documents_str[i] for i in missing], show_progress_bar=True)
+        print(f"Embeddings: {len(missing)} encoded, {len(reused)} reused")
+
+        self.embeddings = embeddings
+        self.__save_embeddings(hashes)
+        self.__prepare_embeddings()
+        return self.embeddings
+
+    def __save_embeddings(self, hashes: list[str]):
         with open("./cache/movie_embeddings.npy", "wb") as f:
             np.save(f, self.embeddings)
-        return self.embeddings
+        with open("./cache/movie_embeddings_hashes.json", "w") as f:
+            json.dump({"hashes": hashes}, f)
+        # quantized copies of the old rows are stale now
+        remove_derived_caches("movie_embeddings.*.npz")
+
+    def __prepare_embeddings(self):
+        if self.quantization == "float32":
+            # normalize once here so a query is a single matrix-vector product
+            self.normalized_embeddings = normalize_rows(self.embeddings)
+            return
+        self.quantized_embeddings = load_or_create_quantized(
+            f"./cache/movie_embeddings.{self.quantization}.npz", self.embeddings, self.quantization
+        )
 
     def load_or_create_embeddings(self, documents):
         self.documents = documents
@@ -36,113 +168,441 @@ class SemanticSearch:
         for doc in documents:
             self.document_map[doc["id"]] = doc
             documents_str.append(f"{doc['title']}: {doc['description']}")
-        if os.path.exists("cache/movie_embeddings.npy"):
-            with open("cache/movie_embeddings.npy", "rb") as f:
-                self.embeddings = np.load(f)
+        if os.path.exists("cache/movie_embeddings.npy") and os.path.exists("cache/movie_embeddings_hashes.json"):
+            with open("cache/movie_embeddings_hashes.json", "r") as f:
+                cached_hashes = json.load(f)["hashes"]
+            # every row must match its document's current text
+            if cached_hashes == [text_hash(text) for text in documents_str]:
+                mmap_mode = None if self.quantization == "float32" else "r"
+                self.embeddings = np.load("cache/movie_embeddings.npy", mmap_mode=mmap_mode)
                 if len(self.embeddings) == len(self.documents):
+                    self.__prepare_embeddings()
                     return self.embeddings
-        return self.build_embeddings(documents)
-    
+        return self.update_embeddings(documents)
+
+    def __score_documents(self, query_embedding: np.ndarray, limit: int):
+        # returns (rows, scores), every row unless quantized candidates were rescored
+        if self.quantized_embeddings is None:
+            # rows are normalized at load time, so this is cosine similarity
+            return np.arange(len(self.embeddings)), self.normalized_embeddings @ query_embedding
+        depth = max(self.rescore, limit) if self.rescore > 0 else 0
+        return rescore(self.quantized_embeddings, self.embeddings, query_embedding, depth)
+
     def search(self, query: str, limit: int):
-        if len(self.embeddings) == 0:
+        if self.embeddings is None or len(self.embeddings) == 0:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
-        scores = []
-        query_embedding = self.generate_embeddings(query)
-        for index, doc_embedding in enumerate(self.embeddings):
-            similarity_score = cosine_similarity(query_embedding, doc_embedding)
-            scores.append((similarity_score, self.documents[index]))
+        query_embedding = normalize_vector(self.generate_embeddings(query))
+        with tracing.stage("semantic.scan"):
+            rows, scores = self.__score_documents(query_embedding, limit)
+        tracing.count("semantic.documents_scored", len(scores))
+        with tracing.stage("semantic.rank"):
+            return [(float(scores[index]), self.documents[rows[index]]) for index in top_k_indices(scores, limit)]
 
-        sorted_scores = sorted(scores, key=lambda item:item[0], reverse=True)
-        return sorted_scores[:limit]
+    def search_batch(self, queries: list[str], limit: int):
+        if self.embeddings is None or len(self.embeddings) == 0:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        if len(queries) == 0:
+            return []
+        query_embeddings = normalize_rows(self.generate_embeddings_batch(queries))
+        if self.quantized_embeddings is not None:
+            results = []
+            for query_embedding in query_embeddings:
+                rows, scores = self.__score_documents(query_embedding, limit)
+                results.append([(float(scores[index]), self.documents[rows[index]]) for index in top_k_indices(scores, limit)])
+            return results
+        # one (queries x documents) matrix product for the whole batch
+        scores = query_embeddings @ self.normalized_embeddings.T
+        return [
+            [(float(row[index]), self.documents[index]) for index in top_k_indices(row, limit)]
+            for row in scores
+        ]
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name="all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantization="float32", rescore=DEFAULT_RESCORE, query_cache_path=QUERY_CACHE_PATH, encode_workers=1, cache_dir="./cache") -> None:
+        super().__init__(model_name, quantization, rescore, query_cache_path, encode_workers)
+        # chunk embeddings and everything derived from them live here, a
+        # shard keeps its own
+        self.cache_dir = cache_dir
         self.chunk_embeddings = None
-        self.chunk_metadata = None
+        self.normalized_chunk_embeddings = None
+        self.quantized_chunk_embeddings = None
+        self.chunk_metadata: ChunkMetadata = None
+        self.ivf_index = None
+        self.__filter_index = None
+
+    def __cache_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
 
     def build_chunk_embeddings(self, documents):
+        # chunks are streamed through the model a batch at a time and written
+        # into a memory mapped .npy; a checkpoint after every batch lets a
+        # killed build pick up where it stopped
         self.documents = documents
-        
-        chunk_metadata = []
-        all_chunks = []
+        for document in documents:
+            self.document_map[document["id"]] = document
+        hashes = chunk_hashes(documents)
+        # the checkpoint is rewritten every batch, so it keeps one digest of
+        # the descriptions rather than every hash
+        digest = text_hash("\n".join(hashes))
 
-        for i, document in enumerate(documents):
+        # the first pass only keeps metadata, it sizes the output file
+        movie_idx = []
+        chunk_idx = []
+        for i, j, _ in iter_document_chunks(documents):
+            movie_idx.append(i)
+            chunk_idx.append(j)
+        total = len(movie_idx)
+
+        embeddings = None
+        done = 0
+        checkpoint = None
+        partial_path = self.__cache_path(CHUNK_PARTIAL_FILE)
+        checkpoint_path = self.__cache_path(CHUNK_CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path) and os.path.exists(partial_path):
+            with open(checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+        if (
+            checkpoint is not None
+            and checkpoint.get("total_chunks") == total
+            and checkpoint.get("digest") == digest
+            and checkpoint.get("model_name") == self.model_name
+        ):
+            embeddings = np.load(partial_path, mmap_mode="r+")
+            done = checkpoint["done"]
+            print(f"Resuming chunk build at {done}/{total} chunks")
+
+        start = time.perf_counter()
+        encoded = 0
+        chunks = islice((chunk for _, _, chunk in iter_document_chunks(documents)), done, None)
+        with self.encoder() as encoder:
+            for batch in batched(chunks, ENCODE_BATCH_SIZE):
+                batch_embeddings = encoder.encode(batch)
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(
+                        partial_path, mode="w+", dtype=np.float32, shape=(total, batch_embeddings.shape[1])
+                    )
+                embeddings[done : done + len(batch)] = batch_embeddings
+                embeddings.flush()
+                done += len(batch)
+                encoded += len(batch)
+                write_json_atomic(checkpoint_path, {"total_chunks": total, "done": done, "digest": digest, "model_name": self.model_name})
+                print(f"Encoded {done}/{total} chunks, {encoded / (time.perf_counter() - start):.1f} chunks/sec", end="\r")
+        if encoded > 0:
+            print(f"\nEncoded {encoded} chunks in {time.perf_counter() - start:.1f}s")
+
+        if embeddings is None:
+            with open(self.__cache_path("chunk_embeddings.npy"), "wb") as f:
+                np.save(f, np.empty((0, 0), dtype=np.float32))
+        else:
+            del embeddings
+            os.replace(partial_path, self.__cache_path("chunk_embeddings.npy"))
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        mmap_mode = None if self.quantization == "float32" else "r"
+        self.chunk_embeddings = np.load(self.__cache_path("chunk_embeddings.npy"), mmap_mode=mmap_mode)
+        self.chunk_metadata = ChunkMetadata(movie_idx, chunk_idx, hashes)
+        self.__save_chunk_metadata()
+        self.__prepare_chunks()
+        return self.chunk_embeddings
+
+    def update_chunk_embeddings(self, documents):
+        # chunks only depend on the description, so a movie whose
+        # description hash is unchanged keeps its rows and is not re-chunked;
+        # rows are keyed by (hash, occurrence) so movies sharing a
+        # description each keep their own block
+        self.documents = documents
+        for document in documents:
             self.document_map[document["id"]] = document
+        hashes = chunk_hashes(documents)
+
+        old_embeddings = None
+        old_rows = {}
+        old_metadata = ChunkMetadata.load_or_migrate(self.__cache_path(CHUNK_METADATA_FILE), self.__cache_path(LEGACY_CHUNK_METADATA_FILE))
+        if os.path.exists(self.__cache_path("chunk_embeddings.npy")) and old_metadata is not None and old_metadata.doc_hashes is not None:
+            old_embeddings = np.load(self.__cache_path("chunk_embeddings.npy"), mmap_mode="r")
+            occurrences = {}
+            for movie_idx, doc_hash in enumerate(old_metadata.doc_hashes):
+                occurrence = occurrences.get(doc_hash, 0)
+                occurrences[doc_hash] = occurrence + 1
+                old_rows[(doc_hash, occurrence)] = old_metadata.movie_rows(movie_idx)
+        if len(old_rows) == 0:
+            return self.build_chunk_embeddings(documents)
 
+        movie_idx = []
+        chunk_idx = []
+        sources = []
+        new_chunks = []
+        reused = 0
+        occurrences = {}
+        for i, document in enumerate(documents):
+            occurrence = occurrences.get(hashes[i], 0)
+            occurrences[hashes[i]] = occurrence + 1
             if not document["description"]:
                 continue
+            if (hashes[i], occurrence) in old_rows:
+                rows = old_rows[(hashes[i], occurrence)]
+                sources += rows
+                reused += 1
+            else:
+                chunks = semantic_chunk(document["description"], 4, 1)
+                rows = range(-len(new_chunks) - 1, -len(new_chunks) - len(chunks) - 1, -1)
+                sources += rows
+                new_chunks += chunks
+            movie_idx += [i] * len(rows)
+            chunk_idx += range(len(rows))
 
-            chunks = semantic_chunk(document["description"], 4, 1)
-            for j, chunk in enumerate(chunks):
-                print(f"Processing: Document {i+1}/{len(documents)}", end="\r")
-                all_chunks.append(chunk)
-                chunk_metadata.append({"movie_idx": i, "chunk_idx": j, "total_chunks": len(chunks)})
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_metadata
-        with open("./cache/chunk_embeddings.npy", "wb") as f:
-            np.save(f, self.chunk_embeddings)
-        with open("./cache/chunk_metadata.json", "w") as f2:
-            json.dump({"chunks": chunk_metadata, "total_chunks": len(all_chunks)}, f2, indent=2)
+        # sources >= 0 are rows of the old matrix, -1, -2, ... index new_chunks
+        sources = np.array(sources, dtype=np.int64)
+        embeddings = np.empty((len(sources), old_embeddings.shape[1]), dtype=np.float32)
+        is_old = sources >= 0
+        embeddings[is_old] = old_embeddings[sources[is_old]]
+        if len(new_chunks) > 0:
+            with self.encoder() as encoder:
+                embeddings[~is_old] = encoder.encode(new_chunks)[-sources[~is_old] - 1]
+        print(f"Chunk embeddings: {len(new_chunks)} chunks encoded, {reused} movies reused")
+
+        self.chunk_embeddings = embeddings
+        self.chunk_metadata = ChunkMetadata(movie_idx, chunk_idx, hashes)
+        self.__save_chunks()
+        self.__prepare_chunks()
         return self.chunk_embeddings
 
+    def __save_chunks(self):
+        with open(self.__cache_path("chunk_embeddings.npy"), "wb") as f:
+            np.save(f, self.chunk_embeddings)
+        self.__save_chunk_metadata()
+
+    def __save_chunk_metadata(self):
+        self.chunk_metadata.save(self.__cache_path(CHUNK_METADATA_FILE))
+        # quantized copies and the IVF lists point at the old rows
+        remove_derived_caches("chunk_embeddings.*.npz", self.cache_dir)
+        remove_derived_caches("chunk_ivf.npz", self.cache_dir)
+        self.ivf_index = None
+
+    def __prepare_chunks(self):
+        self.__filter_index = None
+        if self.quantization == "float32":
+            # normalize once here so a query is a single matrix-vector product
+            self.normalized_chunk_embeddings = normalize_rows(self.chunk_embeddings)
+        else:
+            self.quantized_chunk_embeddings = load_or_create_quantized(
+                self.__cache_path(f"chunk_embeddings.{self.quantization}.npz"), self.chunk_embeddings, self.quantization
+            )
+
     def load_or_create_chunked_embeddings(self, documents: list[dict]) -> np.ndarray:
         self.documents = documents
         for doc in documents:
             self.document_map[doc["id"]] = doc
 
-        if os.path.exists("cache/chunk_embeddings.npy") and os.path.exists("cache/chunk_metadata.json"):
-            with open("cache/chunk_embeddings.npy", "rb") as f:
-                self.chunk_embeddings = np.load(f)
-            with open("cache/chunk_metadata.json", "r") as f2:
-                self.chunk_metadata = json.load(f2)
-            return self.chunk_embeddings
-        else:
-            return self.build_chunk_embeddings(documents)
+        chunk_metadata = ChunkMetadata.load_or_migrate(self.__cache_path(CHUNK_METADATA_FILE), self.__cache_path(LEGACY_CHUNK_METADATA_FILE))
+        if os.path.exists(self.__cache_path("chunk_embeddings.npy")) and chunk_metadata is not None:
+            # every movie's chunks must match its current description
+            if chunk_metadata.matches(chunk_hashes(documents)):
+                mmap_mode = None if self.quantization == "float32" else "r"
+                self.chunk_embeddings = np.load(self.__cache_path("chunk_embeddings.npy"), mmap_mode=mmap_mode)
+                self.chunk_metadata = chunk_metadata
+                self.__prepare_chunks()
+                return self.chunk_embeddings
+        return self.update_chunk_embeddings(documents)
+
+    def build_ann(self, nlist: int | None = None):
+        vectors = self.normalized_chunk_embeddings
+        if vectors is None:
+            vectors = normalize_rows(self.chunk_embeddings)
+        self.ivf_index = IVFIndex.build(vectors, nlist)
+        self.ivf_index.save(self.__cache_path("chunk_ivf.npz"))
+        return self.ivf_index
+
+    def load_or_create_ann(self, nlist: int | None = None):
+        # lives next to chunk_embeddings.npy, rebuilt when the chunk count changes
+        self.ivf_index = IVFIndex.load(self.__cache_path("chunk_ivf.npz"))
+        if self.ivf_index is not None and self.ivf_index.n_vectors == len(self.chunk_embeddings):
+            if nlist is None or nlist == self.ivf_index.nlist:
+                return self.ivf_index
+        return self.build_ann(nlist)
     
-    def search_chunks(self, query: str, limit: int = 10):
-        chunk_scores = [] 
-        movie_scores = {}
+    def filter_index(self):
+        # bitmaps over self.documents, positions are movie_idx
+        if self.__filter_index is None:
+            self.__filter_index = FilterIndex.build(self.documents)
+        return self.__filter_index
+
+    def search_chunks(self, query: str, limit: int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE, filters=None, facets: list[str] | None = None):
+        # filters and facets as in InvertedIndex.bm25_search, every movie
+        # with chunks matches a semantic query
+        movie_mask = None
+        if filters:
+            with tracing.stage("chunks.filter"):
+                movie_mask = self.filter_index().mask(filters)
+        results = []
         query = query.strip()
-        if len(query) == 0:
-            return []
-        query_embedding = self.generate_embeddings(query)
-
-        for index, doc_embedding in enumerate(self.chunk_embeddings):
-            print(f"Searching: Document {index+1}/{len(self.chunk_embeddings)}", end="\r")
-            score = cosine_similarity(query_embedding, doc_embedding)
-            chunk_metadata_2 = self.chunk_metadata["chunks"][index]
-            movie_idx = chunk_metadata_2["movie_idx"]
-            chunk_idx = chunk_metadata_2["chunk_idx"]
-            chunk_scores.append({"chunk_idx":chunk_idx, "movie_idx":movie_idx, "score":score})
-            if movie_idx not in movie_scores or score > movie_scores[movie_idx]:
-                movie_scores[movie_idx] = score
-
-        sorted_movie_scores_2 = sorted(movie_scores.items(), key=lambda item: item[1], reverse=True)
-        sorted_movie_scores = dict(sorted_movie_scores_2[:limit])
+        if len(query) > 0:
+            query_embedding = normalize_vector(self.generate_embeddings(query))
+            results = self.__score_chunks(query_embedding, limit, ann, nprobe, movie_mask)
+        if facets is None:
+            return results
+        with tracing.stage("chunks.facets"):
+            has_chunks = np.diff(self.chunk_metadata.movie_offsets) > 0
+            return results, self.filter_index().facets(has_chunks if movie_mask is None else has_chunks & movie_mask, facets)
+
+    def search_chunks_by_embedding(self, query_embedding: np.ndarray, limit: int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE, filters=None):
+        # for callers that encode the query themselves, say once for every shard
+        movie_mask = self.filter_index().mask(filters) if filters else None
+        return self.__score_chunks(normalize_vector(query_embedding), limit, ann, nprobe, movie_mask)
+
+    def search_chunks_batch(self, queries: list[str], limit: int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE):
+        queries = [query.strip() for query in queries]
+        non_empty = [i for i, query in enumerate(queries) if len(query) > 0]
+        results = [[] for _ in queries]
+        if len(non_empty) == 0:
+            return results
+        query_embeddings = normalize_rows(self.generate_embeddings_batch([queries[i] for i in non_empty]))
+        if ann or self.quantized_chunk_embeddings is not None:
+            for i, query_embedding in zip(non_empty, query_embeddings):
+                results[i] = self.__score_chunks(query_embedding, limit, ann, nprobe)
+            return results
+        # one (queries x chunks) matrix product for the whole batch
+        chunk_scores = query_embeddings @ self.normalized_chunk_embeddings.T
+        for i, row in zip(non_empty, chunk_scores):
+            results[i] = self.__rank_movies(row, limit)
+        return results
+
+    def ann_recall_report(self, queries: list[str], limit: int = 10, nprobes=(1, 2, 4, 8, 16)):
+        # recall@limit of ANN movie results against the exact scan, plus
+        # the mean scoring time per query for each setting
+        if self.ivf_index is None:
+            self.load_or_create_ann()
+        query_embeddings = normalize_rows(self.generate_embeddings_batch(queries))
+
+        start = time.perf_counter()
+        exact = [[r["id"] for r in self.__score_chunks(q, limit, False, 0)] for q in query_embeddings]
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        report = []
+        for nprobe in nprobes:
+            start = time.perf_counter()
+            approx = [[r["id"] for r in self.__score_chunks(q, limit, True, nprobe)] for q in query_embeddings]
+            ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            recall = sum(recall_at_k(e, a) for e, a in zip(exact, approx)) / len(queries)
+            report.append({"nprobe": nprobe, "recall": recall, "ann_ms": ann_ms, "exact_ms": exact_ms})
+        return report
+
+    def quantization_report(self, queries: list[str], limit: int = 10, modes=QUANTIZATION_MODES):
+        # footprint and recall@limit of each storage mode against float32,
+        # with and without full precision rescoring
+        normalized = normalize_rows(self.chunk_embeddings)
+        query_embeddings = normalize_rows(self.generate_embeddings_batch(queries))
+        exact = [[r["id"] for r in self.__rank_movies(normalized @ q, limit)] for q in query_embeddings]
+        depth = max(self.rescore, limit)
+
+        report = []
+        for mode in modes:
+            quantized = QuantizedEmbeddings.build(normalized, mode)
+            raw_recall = 0.0
+            rescored_recall = 0.0
+            start = time.perf_counter()
+            for query_embedding, exact_ids in zip(query_embeddings, exact):
+                approx = self.__rank_movies(quantized.score(query_embedding), limit)
+                raw_recall += recall_at_k(exact_ids, [r["id"] for r in approx])
+                rows, scores = rescore(quantized, self.chunk_embeddings, query_embedding, depth)
+                rescored = self.__rank_movies(scores, limit, rows)
+                rescored_recall += recall_at_k(exact_ids, [r["id"] for r in rescored])
+            report.append({
+                "mode": mode,
+                "bytes": quantized.nbytes,
+                "compression": normalized.nbytes / quantized.nbytes,
+                "recall": raw_recall / len(queries),
+                "rescored_recall": rescored_recall / len(queries),
+                "ms": (time.perf_counter() - start) * 1000 / len(queries),
+            })
+        return report
+
+    def __score_chunks(self, query_embedding: np.ndarray, limit: int, ann: bool, nprobe: int, movie_mask: np.ndarray | None = None):
+        rows = None
+        if ann:
+            if self.ivf_index is None:
+                with tracing.stage("chunks.load_ann"):
+                    self.load_or_create_ann()
+            # only the rows in the probed inverted lists are scored
+            with tracing.stage("chunks.ann_probe"):
+                rows = self.ivf_index.candidates(query_embedding, nprobe)
+        if movie_mask is not None:
+            # filtered movies' chunks are masked out before the matmul
+            chunk_movies = self.chunk_metadata.movie_idx
+            if rows is not None:
+                rows = rows[movie_mask[chunk_movies[rows]]]
+                # a selective filter can leave fewer than `limit` movies in
+                # the probed lists; probe twice as many lists until they hold
+                # enough, ending in the exact masked scan
+                wanted = min(limit, np.count_nonzero(movie_mask & (np.diff(self.chunk_metadata.movie_offsets) > 0)))
+                while rows is not None and len(np.unique(chunk_movies[rows])) < wanted:
+                    nprobe *= 2
+                    tracing.count("chunks.ann_widened")
+                    if nprobe >= self.ivf_index.nlist:
+                        rows = None
+                    else:
+                        with tracing.stage("chunks.ann_probe"):
+                            rows = self.ivf_index.candidates(query_embedding, nprobe)
+                        rows = rows[movie_mask[chunk_movies[rows]]]
+            if rows is None:
+                rows = np.flatnonzero(movie_mask[chunk_movies])
+            if len(rows) == 0:
+                return []
+        tracing.count("chunks.scanned", len(self.chunk_metadata) if rows is None else len(rows))
+        with tracing.stage("chunks.scan"):
+            if self.quantized_chunk_embeddings is not None:
+                depth = max(self.rescore, limit) if self.rescore > 0 else 0
+                rows, scores = rescore(self.quantized_chunk_embeddings, self.chunk_embeddings, query_embedding, depth, rows)
+            elif rows is None:
+                scores = self.normalized_chunk_embeddings @ query_embedding
+            else:
+                scores = self.normalized_chunk_embeddings[rows] @ query_embedding
+        with tracing.stage("chunks.rank"):
+            return self.__rank_movies(scores, limit, rows)
+
+    def __rank_movies(self, chunk_scores: np.ndarray, limit: int, rows: np.ndarray | None = None):
+        # chunk_scores[i] belongs to chunk rows[i], or to chunk i when every
+        # chunk was scored
+        metadata = self.chunk_metadata
+        # best chunk score per movie, movies without chunks stay at -inf
+        movie_scores = np.full(len(self.documents), -np.inf, dtype=chunk_scores.dtype)
+        if rows is None:
+            # every movie's chunks are one contiguous run of the scores
+            starts = metadata.movie_offsets[:-1]
+            has_chunks = metadata.movie_offsets[1:] > starts
+            if has_chunks.any():
+                movie_scores[has_chunks] = np.maximum.reduceat(chunk_scores, starts[has_chunks])
+        else:
+            chunk_movie_idx = metadata.movie_idx[rows]
+            np.maximum.at(movie_scores, chunk_movie_idx, chunk_scores)
+        candidates = np.flatnonzero(movie_scores > -np.inf)
+
         results = []
-        for index, movie_score_key in enumerate(sorted_movie_scores.keys()):
-            document = self.documents[movie_score_key]
+        for movie_idx in candidates[top_k_indices(movie_scores[candidates], limit)]:
+            document = self.documents[movie_idx]
+            if rows is None:
+                movie_rows = metadata.movie_rows(movie_idx)
+                best_chunk = movie_rows.start + int(np.argmax(chunk_scores[movie_rows.start : movie_rows.stop]))
+            else:
+                movie_chunks = np.flatnonzero(chunk_movie_idx == movie_idx)
+                best_chunk = rows[movie_chunks[np.argmax(chunk_scores[movie_chunks])]]
             results.append(
                 {
                     "id": document["id"],
                     "title": document["title"],
                     "document": document["description"][:100],
-                    "score": round(sorted_movie_scores[movie_score_key], 4),
-                    "metadata": chunk_metadata_2 or {}
+                    "score": round(float(movie_scores[movie_idx]), 4),
+                    "metadata": metadata.record(best_chunk)
                 }
             )
         return results
 
-def verify_embeddings():
-    ss = SemanticSearch()
-    documents = []
-    with open("./data/movies.json", "r") as file:
-        data = json.load(file)
-        if "movies" not in data:
-            print("ERROR: Key 'movies' not found in dictionary")
-            return
-        documents = data.get("movies")
+def verify_embeddings(encode_workers: int = 1):
+    ss = SemanticSearch(encode_workers=encode_workers)
+    documents = load_documents()
+    if documents is None:
+        return
     embeddings = ss.load_or_create_embeddings(documents)
     print(f"Number of docs:   {len(documents)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
@@ -177,6 +637,59 @@ def cosine_similarity(vec1, vec2) -> float:
 
     return dot_product / (norm1 * norm2)
 
+def iter_document_chunks(documents):
+    # (movie_idx, chunk_idx, chunk text) for every chunk of every movie, in order
+    for i, document in enumerate(documents):
+        if not document["description"]:
+            continue
+        for j, chunk in enumerate(semantic_chunk(document["description"], 4, 1)):
+            yield i, j, chunk
+
+def write_json_atomic(path: str, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+def chunk_hashes(documents: list[dict]) -> list[str]:
+    return [text_hash(document["description"] or "") for document in documents]
+
+def remove_derived_caches(pattern: str, cache_dir: str = "./cache"):
+    for path in glob.glob(os.path.join(cache_dir, pattern)):
+        os.remove(path)
+
+def load_or_create_quantized(path: str, embeddings: np.ndarray, mode: str) -> QuantizedEmbeddings:
+    quantized = QuantizedEmbeddings.load(path)
+    if quantized is not None and quantized.mode == mode and len(quantized) == len(embeddings):
+        return quantized
+    quantized = QuantizedEmbeddings.build(normalize_rows(embeddings), mode)
+    quantized.save(path)
+    return quantized
+
+def normalize_rows(matrix) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # zero rows stay zero and score 0.0, same as cosine_similarity
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def normalize_vector(vec) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        return vec
+    return vec / norm
+
+def top_k_indices(scores, k: int) -> np.ndarray:
+    # indices of the k highest scores, best first, ties by index
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.lexsort((indices, -scores[indices]))]
+
 DEFAULT_SEMANTIC_CHUNK_SIZE = 4
 DEFAULT_CHUNK_OVERLAP = 1
 def semantic_chunk(
@@ -185,7 +698,6 @@ def semantic_chunk(
     overlap: int = DEFAULT_CHUNK_OVERLAP,
 ) -> list[str]:
     chunks = []
-    print(text)
     text = text.strip()
     if len(text) == 0:
         return chunks
@@ -0,0 +1,265 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .ann import DEFAULT_NPROBE
+from .chunk_metadata import CHUNK_METADATA_FILE, ChunkMetadata
+from .documents import generate_corpus, iter_documents, load_documents, read_jsonl
+from .filters import parse_filters
+from .keyword_search import InvertedIndex, tokenize
+from .quantization import DEFAULT_RESCORE
+from .semantic_search import ChunkedSemanticSearch, SemanticSearch, chunk_hashes
+
+# under the cache directory, ./cache unless a caller gives another
+SHARD_DIR = "shard_{}"
+SHARDS_META_FILE = "shards.json"
+SHARD_DOCUMENTS_FILE = "documents.jsonl"
+# corpus wide N, avgdl and the df of every term in the shard's vocabulary
+GLOBAL_STATS_FILE = "global_stats.json"
+# every verification query is also run under each of these
+VERIFY_FILTERS = [None, ["genre=drama"], ["year>=2000", "genre!=comedy"], ["genre=horror|western", "year=1960..1990"]]
+
+# each worker process serves exactly one shard
+worker_shard_dir = None
+worker_index = None
+worker_chunks = None
+worker_quantization = "float32"
+worker_rescore = DEFAULT_RESCORE
+
+
+def init_shard_worker(shard_dir: str, quantization: str = "float32", rescore: int = DEFAULT_RESCORE):
+    global worker_shard_dir, worker_quantization, worker_rescore
+    worker_shard_dir = shard_dir
+    worker_quantization = quantization
+    worker_rescore = rescore
+
+
+def shard_index() -> InvertedIndex:
+    global worker_index
+    if worker_index is None:
+        worker_index = new_index(worker_shard_dir)
+        worker_index.load()
+        with open(os.path.join(worker_shard_dir, GLOBAL_STATS_FILE), "r") as f:
+            stats = json.load(f)
+        worker_index.set_global_stats(stats["doc_count"], stats["avg_doc_length"], stats["doc_freqs"])
+    return worker_index
+
+
+def shard_chunks() -> ChunkedSemanticSearch:
+    # the shard's rows were sliced out of the global matrix at build time,
+    # so they load as is and nothing is encoded here
+    global worker_chunks
+    if worker_chunks is None:
+        worker_chunks = ChunkedSemanticSearch(
+            quantization=worker_quantization, rescore=worker_rescore, query_cache_path=None, cache_dir=worker_shard_dir
+        )
+        worker_chunks.load_or_create_chunked_embeddings(load_documents(os.path.join(worker_shard_dir, SHARD_DOCUMENTS_FILE)))
+    return worker_chunks
+
+
+def new_index(shard_dir: str) -> InvertedIndex:
+    index = InvertedIndex()
+    index.index_path = os.path.join(shard_dir, "segment")
+    return index
+
+
+def build_shard_index() -> tuple[int, int, dict]:
+    # phase one of a build: index the shard and report its local statistics
+    global worker_index
+    worker_index = new_index(worker_shard_dir)
+    worker_index.build(path=os.path.join(worker_shard_dir, SHARD_DOCUMENTS_FILE))
+    doc_freqs = {token: len(postings) for token, postings in worker_index.index.items()}
+    return len(worker_index.docmap), sum(worker_index.doc_lengths.values()), doc_freqs
+
+
+def save_shard_index(doc_count: int, avg_doc_length: float, doc_freqs: dict):
+    # phase two: the stored max impacts are computed with the global
+    # statistics, so MaxScore pruning stays valid on every shard
+    worker_index.set_global_stats(doc_count, avg_doc_length, doc_freqs)
+    worker_index.save()
+    with open(os.path.join(worker_shard_dir, GLOBAL_STATS_FILE), "w") as f:
+        json.dump({"doc_count": doc_count, "avg_doc_length": avg_doc_length, "doc_freqs": doc_freqs}, f)
+
+
+def shard_bm25_search(query: str, limit: int, filters=None) -> list[dict]:
+    return list(shard_index().bm25_search(query, limit, filters).values())
+
+
+def shard_search_chunks(query_embedding: np.ndarray, limit: int, ann: bool, nprobe: int, filters=None) -> list[dict]:
+    return shard_chunks().search_chunks_by_embedding(query_embedding, limit, ann, nprobe, filters)
+
+
+def shard_executor(shard_dir: str, quantization: str = "float32", rescore: int = DEFAULT_RESCORE) -> ProcessPoolExecutor:
+    # one process per shard, so a shard's index is loaded once and stays
+    # in that process; spawn, as torch's thread pools don't survive a fork
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_shard_worker,
+        initargs=(shard_dir, quantization, rescore),
+    )
+
+
+def shard_bounds(n: int, shards: int) -> list[int]:
+    # contiguous, near equal ranges in document order
+    return [round(i * n / shards) for i in range(shards + 1)]
+
+
+def build_shards(shards: int, path: str | None = None, chunks: bool = True, encode_workers: int = 1, cache_dir: str = "./cache"):
+    documents = list(iter_documents(path))
+    bounds = shard_bounds(len(documents), shards)
+    shard_dirs = [os.path.join(cache_dir, SHARD_DIR.format(i)) for i in range(shards)]
+    for i, shard_dir in enumerate(shard_dirs):
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+        with open(os.path.join(shard_dir, SHARD_DOCUMENTS_FILE), "w") as f:
+            for document in documents[bounds[i] : bounds[i + 1]]:
+                f.write(json.dumps(document) + "\n")
+
+    executors = [shard_executor(shard_dir) for shard_dir in shard_dirs]
+    try:
+        local_stats = [future.result() for future in [executor.submit(build_shard_index) for executor in executors]]
+        doc_count = sum(count for count, _, _ in local_stats)
+        total_length = sum(length for _, length, _ in local_stats)
+        avg_doc_length = total_length / doc_count if doc_count > 0 else 0.0
+        doc_freqs = {}
+        for _, _, shard_freqs in local_stats:
+            for token, df in shard_freqs.items():
+                doc_freqs[token] = doc_freqs.get(token, 0) + df
+        # each shard only needs the global df of its own terms
+        futures = [
+            executor.submit(save_shard_index, doc_count, avg_doc_length, {token: doc_freqs[token] for token in shard_freqs})
+            for executor, (_, _, shard_freqs) in zip(executors, local_stats)
+        ]
+        for future in futures:
+            future.result()
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    if chunks:
+        # embed once over the whole corpus (reusing cache_dir when it is up
+        # to date) and hand every shard its contiguous block of rows
+        css = ChunkedSemanticSearch(encode_workers=encode_workers, cache_dir=cache_dir)
+        embeddings = css.load_or_create_chunked_embeddings(documents)
+        metadata = css.chunk_metadata
+        hashes = chunk_hashes(documents)
+        for i, shard_dir in enumerate(shard_dirs):
+            start, end = bounds[i], bounds[i + 1]
+            rows = slice(int(metadata.movie_offsets[start]), int(metadata.movie_offsets[end]))
+            with open(os.path.join(shard_dir, "chunk_embeddings.npy"), "wb") as f:
+                np.save(f, np.asarray(embeddings[rows]))
+            shard_metadata = ChunkMetadata(metadata.movie_idx[rows] - start, metadata.chunk_idx[rows], hashes[start:end])
+            shard_metadata.save(os.path.join(shard_dir, CHUNK_METADATA_FILE))
+
+    with open(os.path.join(cache_dir, SHARDS_META_FILE), "w") as f:
+        json.dump({"shards": shards, "bounds": bounds, "chunks": chunks}, f)
+    return {"shards": shards, "documents": doc_count, "terms": len(doc_freqs)}
+
+
+def verify_shards(work_dir: str, docs: int = 2000, shards: int = 4, queries: int = 100, limit: int = 10, seed: int = 0):
+    # generates a synthetic corpus under work_dir, indexes it whole and in
+    # shards, and checks every query two ways: MaxScore against an
+    # exhaustive ranking of the whole index, and the sharded results
+    # against the whole index, with and without filters. Returns (searches
+    # checked, a line per mismatch)
+    corpus_path = generate_corpus(docs, work_dir, queries, seed=seed)
+    unsharded_dir = os.path.join(work_dir, "unsharded")
+    built = new_index(unsharded_dir)
+    built.build(path=corpus_path)
+    built.save()
+    reference = new_index(unsharded_dir)
+    reference.load()
+    build_shards(shards, corpus_path, chunks=False, cache_dir=work_dir)
+
+    # the known item queries hit a few rare words, a handful of words from
+    # a random movie brings in the frequent ones that MaxScore prunes
+    rng = random.Random(seed)
+    movies = read_jsonl(corpus_path)
+    probes = [entry["query"] for entry in read_jsonl(os.path.join(work_dir, "queries.jsonl"))]
+    for _ in range(len(probes)):
+        words = rng.choice(movies)["description"].split()
+        probes.append(" ".join(rng.sample(words, min(len(words), rng.randint(1, 6)))))
+
+    checked = 0
+    mismatches = []
+    with ShardedSearch(cache_dir=work_dir) as sharded:
+        for query in probes:
+            tokens = tokenize(query)
+            for k in (1, limit):
+                exhaustive = sorted(reference.bm25_scores(tokens).items(), key=lambda item: (-item[1], item[0]))[:k]
+                top_k = reference.bm25_top_k(tokens, k)
+                checked += 1
+                if top_k != exhaustive:
+                    mismatches.append(f"maxscore {query!r} limit {k}: expected {exhaustive}, got {top_k}")
+            for expressions in VERIFY_FILTERS:
+                filters = parse_filters(expressions)
+                expected = [(doc_id, r["score"]) for doc_id, r in reference.bm25_search(query, limit, filters).items()]
+                actual = [(doc_id, r["score"]) for doc_id, r in sharded.bm25_search(query, limit, filters).items()]
+                checked += 1
+                if actual != expected:
+                    mismatches.append(f"sharded {query!r} filters {expressions}: expected {expected}, got {actual}")
+    return checked, mismatches
+
+
+class ShardedSearch:
+    # scatter-gather over the shards built by build_shards: every query is
+    # sent to all shard processes at once and their top-k lists merged
+    def __init__(self, quantization: str = "float32", rescore: int = DEFAULT_RESCORE, model_name: str = "all-MiniLM-L6-v2", cache_dir: str = "./cache"):
+        meta_path = os.path.join(cache_dir, SHARDS_META_FILE)
+        if not os.path.exists(meta_path):
+            raise ValueError(f"{meta_path} does not exist, build the shards first")
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        self.bounds = meta["bounds"]
+        self.has_chunks = meta["chunks"]
+        self.executors = [
+            shard_executor(os.path.join(cache_dir, SHARD_DIR.format(i)), quantization, rescore) for i in range(meta["shards"])
+        ]
+        # queries are encoded here once, not once per shard
+        self.encoder = SemanticSearch(model_name)
+
+    def __len__(self):
+        return len(self.executors)
+
+    def bm25_search(self, query: str, limit: int, filters=None) -> dict:
+        # shards score with the global statistics, so merging on the same
+        # (score, doc id) order as InvertedIndex gives its exact results
+        futures = [executor.submit(shard_bm25_search, query, limit, filters) for executor in self.executors]
+        merged = [r for future in futures for r in future.result()]
+        merged.sort(key=lambda r: (-r["score"], r["movie"]["id"]))
+        return {r["movie"]["id"]: r for r in merged[:limit]}
+
+    def search_chunks(self, query: str, limit: int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE, filters=None) -> list[dict]:
+        if not self.has_chunks:
+            raise ValueError("shards were built without chunk embeddings")
+        query = query.strip()
+        if len(query) == 0:
+            return []
+        query_embedding = self.encoder.generate_embeddings(query)
+        futures = [executor.submit(shard_search_chunks, query_embedding, limit, ann, nprobe, filters) for executor in self.executors]
+        merged = []
+        for shard, future in enumerate(futures):
+            for r in future.result():
+                # movie_idx is local to the shard
+                r["metadata"]["movie_idx"] += self.bounds[shard]
+                merged.append(r)
+        # stable, ties keep shard (document) order
+        merged.sort(key=lambda r: -r["score"])
+        return merged[:limit]
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
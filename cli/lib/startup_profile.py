@@ -0,0 +1,79 @@
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+from itertools import islice
+
+CLI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# packages that take seconds to import, paths that don't encode or stem
+# unindexed words should never load them
+HEAVY_MODULES = ("torch", "sentence_transformers", "transformers", "nltk", "scipy")
+SEGMENT_PATH = "./cache/segment"
+# replaced by words from the saved index's stem table, a query made of
+# words the corpus lacks has to stem them and rightly imports nltk
+INDEXED_QUERY = "{indexed_query}"
+# keyword lookups and argument parsing, none of these need a model
+STARTUP_COMMANDS = [
+    "keyword_search_cli.py --help",
+    f"keyword_search_cli.py bm25search {INDEXED_QUERY}",
+    "semantic_search_cli.py --help",
+    "hybrid_search_cli.py --help",
+    "hybrid_search_cli.py normalize 1 2 3",
+    "search_server_cli.py --help",
+]
+
+
+def parse_importtime(report: str):
+    # `python -X importtime` writes "import time: self [us] | cumulative |
+    # package" per import, nested imports indented two spaces per level;
+    # returns cumulative microseconds of every module and of the top level ones
+    modules = {}
+    top_level = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        cumulative = int(fields[1])
+        modules[name.strip()] = cumulative
+        if len(name) - len(name.lstrip()) == 1:
+            top_level[name.strip()] = cumulative
+    return modules, top_level
+
+
+def indexed_query(words: int = 2, path: str = SEGMENT_PATH) -> str:
+    # the first few alphabetic words the index saved stems for, so the
+    # check passes or fails the same way whatever the corpus contains
+    found = []
+    if os.path.exists(os.path.join(path, "stem_offsets.npy")):
+        from .segment import Segment
+
+        found = list(islice((word for word, _ in Segment(path).stem_items() if word.isalpha()), words))
+    return shlex.quote(" ".join(found)) if len(found) > 0 else "'toy story'"
+
+
+def profile_command(command: str, runs: int = 5, top: int = 10):
+    if INDEXED_QUERY in command:
+        command = command.replace(INDEXED_QUERY, indexed_query())
+    # wall time is the median over fresh interpreters without -X importtime,
+    # which adds its own overhead; one more run collects the import report
+    argv = [sys.executable, *[os.path.join(CLI_DIR, arg) if i == 0 else arg for i, arg in enumerate(shlex.split(command))]]
+    wall_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run(argv, capture_output=True, text=True)
+        wall_times.append(time.perf_counter() - start)
+    traced = subprocess.run([argv[0], "-X", "importtime", *argv[1:]], capture_output=True, text=True)
+    modules, top_level = parse_importtime(traced.stderr)
+    return {
+        "command": command,
+        "returncode": completed.returncode,
+        "wall_ms": statistics.median(wall_times) * 1000,
+        "import_ms": sum(top_level.values()) / 1000,
+        "slowest": [(name, us / 1000) for name, us in sorted(top_level.items(), key=lambda item: -item[1])[:top]],
+        "heavy": sorted(name for name in modules if name in HEAVY_MODULES),
+    }
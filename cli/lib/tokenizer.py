@@ -0,0 +1,44 @@
+import string
+from functools import lru_cache
+
+STOPWORDS_PATH = "./data/stopwords.txt"
+STEM_CACHE_SIZE = 65536
+
+
+class Tokenizer:
+    # lowercase -> strip punctuation -> split -> drop stopwords -> stem,
+    # with everything that doesn't depend on the input built once
+    def __init__(self, stopwords_path: str = STOPWORDS_PATH, stem_cache_size: int = STEM_CACHE_SIZE):
+        self.table = str.maketrans({punc: None for punc in string.punctuation})
+        with open(stopwords_path, "r") as stopwords_file:
+            self.stopwords = frozenset(stopwords_file.read().splitlines())
+        # word -> stem or None, the saved index's stem table so queries made
+        # of indexed words never import nltk, which takes over a second
+        self.stem_lookup = None
+        self.__stemmer = None
+        # vocabularies are zipfian, so most words hit the cache
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.__stem)
+
+    def __stem(self, word: str) -> str:
+        if self.stem_lookup is not None:
+            stem = self.stem_lookup(word)
+            if stem is not None:
+                return stem
+        if self.__stemmer is None:
+            from nltk.stem import PorterStemmer
+
+            self.__stemmer = PorterStemmer()
+        return self.__stemmer.stem(word)
+
+    def tokenize(self, text: str, stems: dict | None = None) -> list[str]:
+        # stems, when given, collects the surface word -> stem pairs seen
+        stopwords = self.stopwords
+        stem = self.stem
+        words = [term for term in text.lower().translate(self.table).split() if term not in stopwords]
+        tokens = [stem(word) for word in words]
+        if stems is not None:
+            stems.update(zip(words, tokens))
+        return tokens
+
+    def tokenize_many(self, texts, stems: dict | None = None) -> list[list[str]]:
+        return [self.tokenize(text, stems) for text in texts]
@@ -0,0 +1,150 @@
+import io
+import threading
+import time
+
+# the trace of the query being profiled; None (the default) turns every
+# hook below into a global lookup and a return
+active = None
+# rows of a cProfile report
+PROFILER_TOP = 25
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+class Trace:
+    # per stage wall time and call count, and named counters; hybrid legs
+    # record into the same trace from two threads
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+        self.total = None
+
+    def add(self, name: str, seconds: float):
+        with self.__lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + 1)
+
+    def count(self, name: str, n: int = 1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def finish(self):
+        self.total = time.perf_counter() - self.__start
+        return self
+
+    def report(self) -> dict:
+        # stages in the order they first ran; concurrent stages overlap, so
+        # they can add up to more than the total
+        return {
+            "total_ms": (self.total or 0.0) * 1000,
+            "stages": {name: {"ms": total * 1000, "calls": calls} for name, (total, calls) in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+
+class Stage:
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name: str):
+    # with stage("keyword.score"): ... times the block into the active trace
+    if active is None:
+        return NULL_STAGE
+    return Stage(active, name)
+
+
+def count(name: str, n: int = 1):
+    if active is not None:
+        active.count(name, n)
+
+
+def start() -> Trace:
+    global active
+    active = Trace()
+    return active
+
+
+def stop():
+    global active
+    trace = active
+    active = None
+    return trace.finish() if trace is not None else None
+
+
+def traced(fn, profile: bool = False, profiler: str | None = None):
+    # runs fn() once, with stage timings when profile is set and under
+    # cProfile or pyinstrument when profiler is; returns (result, trace
+    # or None, profiler report text or None)
+    if profile:
+        start()
+    try:
+        if profiler is None:
+            result, text = fn(), None
+        else:
+            result, text = run_profiler(fn, profiler)
+    finally:
+        trace = stop() if profile else None
+    return result, trace, text
+
+
+def run_profiler(fn, profiler: str):
+    match profiler:
+        case "cprofile":
+            import cProfile
+            import pstats
+
+            capture = cProfile.Profile()
+            result = capture.runcall(fn)
+            out = io.StringIO()
+            pstats.Stats(capture, stream=out).sort_stats("cumulative").print_stats(PROFILER_TOP)
+            return result, out.getvalue()
+        case "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise ValueError("pyinstrument is not installed, install it or use --profiler cprofile")
+            capture = Profiler()
+            capture.start()
+            try:
+                result = fn()
+            finally:
+                capture.stop()
+            return result, capture.output_text()
+    raise ValueError(f"Unknown profiler '{profiler}', expected one of {', '.join(PROFILERS)}")
+
+
+def print_trace(trace: Trace | None, profiler_report: str | None = None):
+    if trace is not None:
+        report = trace.report()
+        print()
+        print(f"profile: {report["total_ms"]:.2f}ms")
+        for name, timing in report["stages"].items():
+            calls = f" x{timing["calls"]}" if timing["calls"] > 1 else ""
+            print(f"   {timing["ms"]:9.3f}ms  {name}{calls}")
+        for name, value in report["counters"].items():
+            print(f"   {value:>11}  {name}")
+    if profiler_report is not None:
+        print()
+        print(profiler_report)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.ann import DEFAULT_NPROBE
+from lib.documents import load_documents
+from lib.quantization import QUANTIZATION_MODES
+from lib.search_client import DEFAULT_HOST, DEFAULT_PORT, remote_stats
+from lib.search_server import serve
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser("serve", help="Load the model and indexes once and answer search requests over HTTP")
+    serve_parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="interface to listen on")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    serve_parser.add_argument("--ann", action="store_true", help="use the IVF approximate nearest neighbour index for semantic search")
+    serve_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="inverted lists to probe with --ann")
+    serve_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="chunk embedding storage mode")
+    serve_parser.add_argument("--concurrent", action="store_true", help="run the keyword and semantic legs of hybrid searches in parallel")
+    serve_parser.add_argument("--leg-timeout", type=float, help="seconds to wait for each concurrent leg before fusing without it")
+
+    stats_parser = subparsers.add_parser("stats", help="Print request latency stats of a running server")
+    stats_parser.add_argument("--server", type=str, default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", help="server url")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            if args.nprobe < 1:
+                serve_parser.error("--nprobe must be at least 1")
+            documents = load_documents()
+            if documents is None:
+                return
+            serve(documents, args.host, args.port, args.ann, args.nprobe, args.quantization, args.concurrent, args.leg_timeout)
+        case "stats":
+            try:
+                stats = remote_stats(args.server)
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            print(f"Uptime: {stats["uptime_s"]:.0f}s, errors: {stats["errors"]}")
+            for mode, mode_stats in stats["modes"].items():
+                if mode_stats["count"] == 0:
+                    print(f"{mode}: no requests")
+                    continue
+                print(f"{mode}: {mode_stats["count"]} requests, mean {mode_stats["mean_ms"]:.1f}ms, p50 {mode_stats["p50_ms"]:.1f}ms, p95 {mode_stats["p95_ms"]:.1f}ms, p99 {mode_stats["p99_ms"]:.1f}ms, max {mode_stats["max_ms"]:.1f}ms")
+            cache_stats = stats["query_cache"]
+            print(f"query cache: {cache_stats["hits"]} hits, {cache_stats["disk_hits"]} disk hits, {cache_stats["misses"]} misses ({cache_stats["hit_rate"]:.1%}), {cache_stats["size"]} in memory")
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
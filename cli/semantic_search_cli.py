@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import re
 
 import lib.semantic_search as ss
+from lib.ann import DEFAULT_NPROBE
+from lib.documents import load_documents
+from lib.filters import parse_filters, print_facets
+from lib.batch import read_queries, write_results
+from lib.quantization import DEFAULT_RESCORE, QUANTIZATION_MODES
+from lib.search_client import remote_search
+from lib.tracing import PROFILERS, print_trace, traced
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -13,6 +19,7 @@ def main():
     verify_parser = subparsers.add_parser("verify", help="Verify model")
 
     verify_embeddings_parser = subparsers.add_parser("verify_embeddings", help="Verify embeddings")
+    verify_embeddings_parser.add_argument("--encode-workers", type=int, default=1, help="processes to encode movies with when (re)building")
 
     embed_parser = subparsers.add_parser("embed_text", help="Embed text")
     embed_parser.add_argument("text", type=str, help="text to embed")
@@ -21,12 +28,35 @@ def main():
     embed_query_parser.add_argument("query", type=str, help="query to embed")
 
     search_parser = subparsers.add_parser("search", help="search")
-    search_parser.add_argument("query", type=str, help="query to search")
+    search_parser.add_argument("query", type=str, nargs="?", help="query to search")
     search_parser.add_argument("--limit", type=int, nargs="?", default=5, help="number of results")
+    search_parser.add_argument("--queries-file", type=str, help="JSONL file of queries to run as one batch, - for stdin")
+    search_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="embedding storage mode")
+    search_parser.add_argument("--rescore", type=int, default=DEFAULT_RESCORE, help="candidates re-scored at full precision when quantized, 0 disables")
+    search_parser.add_argument("--profile", action="store_true", help="print per stage timings and counters after the results")
+    search_parser.add_argument("--profiler", type=str, choices=PROFILERS, help="also run the query under cProfile or pyinstrument and print its report")
 
     search_chunked_parser = subparsers.add_parser("search_chunked", help="search")
-    search_chunked_parser.add_argument("query", type=str, help="query to search")
+    search_chunked_parser.add_argument("query", type=str, nargs="?", help="query to search")
     search_chunked_parser.add_argument("--limit", type=int, nargs="?", default=5, help="number of results")
+    search_chunked_parser.add_argument("--queries-file", type=str, help="JSONL file of queries to run as one batch, - for stdin")
+    search_chunked_parser.add_argument("--server", type=str, help="url of a running search server to query instead of loading locally")
+    search_chunked_parser.add_argument("--ann", action="store_true", help="use the IVF approximate nearest neighbour index")
+    search_chunked_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="inverted lists to probe with --ann, higher is slower with better recall")
+    search_chunked_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="embedding storage mode")
+    search_chunked_parser.add_argument("--rescore", type=int, default=DEFAULT_RESCORE, help="chunks re-scored at full precision when quantized, 0 disables")
+    search_chunked_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+    search_chunked_parser.add_argument("--facets", type=str, nargs="*", help="print value counts of these fields, every faceted field when none are given")
+    search_chunked_parser.add_argument("--profile", action="store_true", help="print per stage timings and counters after the results")
+    search_chunked_parser.add_argument("--profiler", type=str, choices=PROFILERS, help="also run the query under cProfile or pyinstrument and print its report")
+
+    build_ann_parser = subparsers.add_parser("build_ann", help="Build the IVF index over the chunk embeddings")
+    build_ann_parser.add_argument("--nlist", type=int, help="number of k-means lists, defaults to 4*sqrt(chunks)")
+
+    ann_recall_parser = subparsers.add_parser("ann_recall", help="Report ANN recall@k against the exact chunk scan")
+    ann_recall_parser.add_argument("queries_file", type=str, help="JSONL file of queries, - for stdin")
+    ann_recall_parser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+    ann_recall_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="nprobe values to compare")
 
     chunk_parser = subparsers.add_parser("chunk", help="chunk")
     chunk_parser.add_argument("text", type=str, help="text to chunk")
@@ -39,31 +69,51 @@ def main():
     semantic_chunk_parser.add_argument("--overlap", type=int, nargs="?", default=0, help="size of chunks")
 
     embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Embed chunks")
+    embed_chunks_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="also write a compressed copy in this storage mode")
+    embed_chunks_parser.add_argument("--encode-workers", type=int, default=1, help="processes to encode chunks with when (re)building")
+
+    quantization_report_parser = subparsers.add_parser("quantization_report", help="Report footprint and recall loss of each embedding storage mode")
+    quantization_report_parser.add_argument("queries_file", type=str, help="JSONL file of queries, - for stdin")
+    quantization_report_parser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+    quantization_report_parser.add_argument("--rescore", type=int, default=DEFAULT_RESCORE, help="chunks re-scored at full precision")
     # embed_chunks_parser.add_argument("text", type=str, help="text to embed")
 
     args = parser.parse_args()
+    if args.command in ("search", "search_chunked") and args.query is None and args.queries_file is None:
+        parser.error("a query or --queries-file is required")
     match args.command:
         case "verify":
             ss.verify_model()
         case "verify_embeddings":
-            ss.verify_embeddings()
+            ss.verify_embeddings(args.encode_workers)
         case "embed_text":
             ss.embed_text(args.text)
         case "embedquery":
             ss.embed_query_text(args.query)
         case "search":
-            ss2 = ss.SemanticSearch()
-            documents = []
-            with open("./data/movies.json", "r") as file:
-                data = json.load(file)
-                if "movies" not in data:
-                    print("ERROR: Key 'movies' not found in dictionary")
-                    return
-                documents = data.get("movies")
+            if args.queries_file and (args.profile or args.profiler):
+                search_parser.error("--profile and --profiler apply to a single local query")
+            ss2 = ss.SemanticSearch(quantization=args.quantization, rescore=args.rescore)
+            documents = load_documents()
+            if documents is None:
+                return
             embeddings = ss2.load_or_create_embeddings(documents)
-            results = ss2.search(args.query, args.limit)
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+                batch_results = ss2.search_batch(queries, args.limit)
+                write_results(queries, [
+                    [{"id": doc["id"], "title": doc["title"], "score": score} for score, doc in results]
+                    for results in batch_results
+                ])
+                return
+            try:
+                results, trace, profiler_report = traced(lambda: ss2.search(args.query, args.limit), args.profile, args.profiler)
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
             for i, r in enumerate(results):
                 print(f"{i}. {r[1]["title"]} (score: {r[0]:.2f})\r\n{r[1]["description"][:20]}...")
+            print_trace(trace, profiler_report)
         case "chunk":
             chunks = list(ss.chunk_text(args.text.rsplit(), args.chunk_size, args.overlap))
             print(f"Chunking {len(args.text)} characters")
@@ -78,33 +128,89 @@ def main():
             #     c = " ".join(chunk)
             #     print(f"{i+1}. {c}")
         case "embed_chunks":
-            css = ss.ChunkedSemanticSearch()
-            documents = []
-            with open("./data/movies.json", "r") as file:
-                data = json.load(file)
-                if "movies" not in data:
-                    print("ERROR: Key 'movies' not found in dictionary")
-                    return
-                documents = data.get("movies")
-                embeddings = css.load_or_create_chunked_embeddings(documents)
+            css = ss.ChunkedSemanticSearch(quantization=args.quantization, encode_workers=args.encode_workers)
+            documents = load_documents()
+            if documents is None:
+                return
+            embeddings = css.load_or_create_chunked_embeddings(documents)
             print(f"Generated {len(embeddings)} chunked embeddings")
         case "search_chunked":
-            css = ss.ChunkedSemanticSearch()
-            with open("./data/movies.json", "r") as file:
-            # with open("./data/movies_sm.json", "r") as file:
-                data = json.load(file)
-                if "movies" not in data:
-                    print("ERROR: Key 'movies' not found in dictionary")
+            if args.nprobe < 1:
+                search_chunked_parser.error("--nprobe must be at least 1")
+            if args.queries_file and (args.filter or args.facets is not None):
+                search_chunked_parser.error("--filter and --facets apply to a single query, not --queries-file")
+            if args.queries_file and args.server:
+                search_chunked_parser.error("--server runs a single query, not --queries-file")
+            if (args.queries_file or args.server) and (args.profile or args.profiler):
+                search_chunked_parser.error("--profile and --profiler apply to a single local query")
+            if args.server and args.query is not None:
+                try:
+                    results = remote_search(args.server, "semantic", args.query, limit=args.limit, filters=args.filter, facets=args.facets)
+                except ValueError as e:
+                    print(f"ERROR: {e}")
                     return
-                documents = data.get("movies")
-                embeddings = css.load_or_create_chunked_embeddings(documents)
-            results = css.search_chunks(args.query, args.limit)
-            for i,r in enumerate(results):
-                print(f"\n{i+1}. {r["title"]} (score: {r["score"]:.4f})")
-                print(f"   {r["document"]}...")
+                print_chunk_results(results, args.facets is not None)
+                return
+            css = ss.ChunkedSemanticSearch(quantization=args.quantization, rescore=args.rescore)
+            documents = load_documents()
+            if documents is None:
+                return
+            embeddings = css.load_or_create_chunked_embeddings(documents)
+            if args.queries_file:
+                queries = read_queries(args.queries_file)
+                write_results(queries, css.search_chunks_batch(queries, args.limit, args.ann, args.nprobe))
+                return
+            try:
+                results, trace, profiler_report = traced(
+                    lambda: css.search_chunks(args.query, args.limit, args.ann, args.nprobe, parse_filters(args.filter), args.facets), args.profile, args.profiler
+                )
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            print_chunk_results(results, args.facets is not None)
+            print_trace(trace, profiler_report)
+        case "build_ann":
+            css = ss.ChunkedSemanticSearch()
+            documents = load_documents()
+            if documents is None:
+                return
+            css.load_or_create_chunked_embeddings(documents)
+            ivf_index = css.build_ann(args.nlist)
+            print(f"Built IVF index with {ivf_index.nlist} lists over {ivf_index.n_vectors} chunks")
+        case "ann_recall":
+            if min(args.nprobe) < 1:
+                ann_recall_parser.error("--nprobe values must be at least 1")
+            css = ss.ChunkedSemanticSearch()
+            documents = load_documents()
+            if documents is None:
+                return
+            css.load_or_create_chunked_embeddings(documents)
+            report = css.ann_recall_report(read_queries(args.queries_file), args.limit, args.nprobe)
+            for row in report:
+                print(f"nprobe {row["nprobe"]:>4}: recall@{args.limit} {row["recall"]:.4f}, {row["ann_ms"]:.2f}ms/query (exact {row["exact_ms"]:.2f}ms/query)")
+        case "quantization_report":
+            css = ss.ChunkedSemanticSearch(rescore=args.rescore)
+            documents = load_documents()
+            if documents is None:
+                return
+            css.load_or_create_chunked_embeddings(documents)
+            report = css.quantization_report(read_queries(args.queries_file), args.limit)
+            for row in report:
+                print(f"{row["mode"]:>8}: {row["bytes"] / 1024:.0f} KiB ({row["compression"]:.1f}x), recall@{args.limit} {row["recall"]:.4f}, rescored {row["rescored_recall"]:.4f}, {row["ms"]:.2f}ms/query")
         case _:
             parser.print_help()
 
+
+def print_chunk_results(results, with_facets=False):
+    facets = None
+    if with_facets:
+        results, facets = results
+    for i,r in enumerate(results):
+        print(f"\n{i+1}. {r["title"]} (score: {r["score"]:.4f})")
+        print(f"   {r["document"]}...")
+    if facets is not None:
+        print_facets(facets)
+
 # def chunk_text(text, chunk_size, overlap):
 #     for i in range(0, len(text), chunk_size):
 #         if i == 0:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import tempfile
+import time
+
+from lib.ann import DEFAULT_NPROBE
+from lib.filters import parse_filters
+from lib.quantization import DEFAULT_RESCORE, QUANTIZATION_MODES
+from lib.sharding import ShardedSearch, build_shards, verify_shards
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sharded Search CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    build_parser = subparsers.add_parser("build", help="Split the movies into shards under ./cache/shard_i and index each one")
+    build_parser.add_argument("--shards", type=int, default=4, help="number of shards, each is built and served by its own process")
+    build_parser.add_argument("--skip-chunks", action="store_true", help="only build the keyword indexes")
+    build_parser.add_argument("--encode-workers", type=int, default=1, help="processes to encode chunks with when the chunk embeddings are stale")
+
+    bm25search_parser = subparsers.add_parser("bm25search", help="BM25 search across every shard")
+    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("limit", type=int, nargs='?', default=5, help="limit")
+    bm25search_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+
+    search_chunked_parser = subparsers.add_parser("search_chunked", help="Chunked semantic search across every shard")
+    search_chunked_parser.add_argument("query", type=str, help="query to search")
+    search_chunked_parser.add_argument("--limit", type=int, default=5, help="number of results")
+    search_chunked_parser.add_argument("--ann", action="store_true", help="use each shard's IVF approximate nearest neighbour index")
+    search_chunked_parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="inverted lists to probe with --ann, higher is slower with better recall")
+    search_chunked_parser.add_argument("--quantization", type=str, choices=QUANTIZATION_MODES, default="float32", help="embedding storage mode")
+    search_chunked_parser.add_argument("--rescore", type=int, default=DEFAULT_RESCORE, help="chunks re-scored at full precision when quantized, 0 disables")
+    search_chunked_parser.add_argument("--filter", type=str, action="append", help="field=value, field=a|b, field!=value, field=lo..hi or field>=value (repeatable, all must match)")
+
+    verify_parser = subparsers.add_parser("verify", help="Check sharded BM25 results equal a single index on a synthetic corpus, exits 1 on any difference")
+    verify_parser.add_argument("--docs", type=int, default=2000, help="number of synthetic movies")
+    verify_parser.add_argument("--shards", type=int, default=4, help="number of shards")
+    verify_parser.add_argument("--queries", type=int, default=100, help="known item queries, as many random ones are added")
+    verify_parser.add_argument("--limit", type=int, default=10, help="results per query")
+    verify_parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus and queries")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "build":
+            if args.shards < 1:
+                build_parser.error("--shards must be at least 1")
+            start = time.perf_counter()
+            try:
+                built = build_shards(args.shards, chunks=not args.skip_chunks, encode_workers=args.encode_workers)
+            except KeyError:
+                print("ERROR: Key 'movies' not found in dictionary")
+                return
+            print(f"Built {built["shards"]} shards over {built["documents"]} movies ({built["terms"]} terms) in {time.perf_counter() - start:.2f}s")
+        case "bm25search":
+            try:
+                with ShardedSearch() as sharded:
+                    results = sharded.bm25_search(args.query, args.limit, parse_filters(args.filter))
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            for index, r in enumerate(results.values()):
+                print(f"{index}. ({r["movie"]["id"]}) {r["movie"]["title"]} - Score: {r["score"]:.2f}")
+        case "search_chunked":
+            if args.nprobe < 1:
+                search_chunked_parser.error("--nprobe must be at least 1")
+            try:
+                with ShardedSearch(args.quantization, args.rescore) as sharded:
+                    results = sharded.search_chunks(args.query, args.limit, args.ann, args.nprobe, parse_filters(args.filter))
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                return
+            for i, r in enumerate(results):
+                print(f"\n{i+1}. {r["title"]} (score: {r["score"]:.4f})")
+                print(f"   {r["document"]}...")
+        case "verify":
+            if args.shards < 1:
+                verify_parser.error("--shards must be at least 1")
+            # the corpus and every index live in a throwaway directory
+            with tempfile.TemporaryDirectory() as work_dir:
+                checked, mismatches = verify_shards(work_dir, args.docs, args.shards, args.queries, args.limit, args.seed)
+            for mismatch in mismatches:
+                print(mismatch)
+            if len(mismatches) > 0:
+                print(f"ERROR: {len(mismatches)} of {checked} searches differ")
+                sys.exit(1)
+            print(f"OK: {checked} searches over {args.shards} shards match the single index")
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from lib.startup_profile import STARTUP_COMMANDS, profile_command
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    report_parser = subparsers.add_parser("report", help="Time fresh CLI runs and list their slowest imports")
+    report_parser.add_argument("--runs", type=int, default=5, help="runs per command, the median is reported")
+    report_parser.add_argument("--top", type=int, default=10, help="slowest top level imports to list per command")
+    report_parser.add_argument("--cmd", type=str, action="append", help="CLI script and arguments to time, relative to cli/ (repeatable)")
+
+    check_parser = subparsers.add_parser("check", help="Fail if a startup command imports a heavy dependency or runs over budget")
+    check_parser.add_argument("--runs", type=int, default=5, help="runs per command, the median is checked")
+    check_parser.add_argument("--max-ms", type=float, help="wall time budget per command in milliseconds")
+    check_parser.add_argument("--cmd", type=str, action="append", help="CLI script and arguments to time, relative to cli/ (repeatable)")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "report":
+            for command in args.cmd or STARTUP_COMMANDS:
+                profile = profile_command(command, args.runs, args.top)
+                print(f"{profile["command"]}: {profile["wall_ms"]:.1f}ms wall, {profile["import_ms"]:.1f}ms importing")
+                if profile["returncode"] != 0:
+                    print(f"   ERROR: exited with status {profile["returncode"]}")
+                for name, ms in profile["slowest"]:
+                    print(f"   {ms:8.1f}ms  {name}")
+                print(f"   heavy modules: {", ".join(profile["heavy"]) or "none"}")
+        case "check":
+            failures = 0
+            for command in args.cmd or STARTUP_COMMANDS:
+                profile = profile_command(command, args.runs, 0)
+                problems = []
+                if profile["returncode"] != 0:
+                    problems.append(f"exited with status {profile["returncode"]}")
+                if len(profile["heavy"]) > 0:
+                    problems.append(f"imported {", ".join(profile["heavy"])}")
+                if args.max_ms is not None and profile["wall_ms"] > args.max_ms:
+                    problems.append(f"took {profile["wall_ms"]:.1f}ms, budget {args.max_ms:.1f}ms")
+                if len(problems) > 0:
+                    failures += 1
+                    print(f"ERROR: {profile["command"]}: {"; ".join(problems)}")
+                else:
+                    print(f"OK {profile["command"]}: {profile["wall_ms"]:.1f}ms")
+            if failures > 0:
+                sys.exit(1)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()